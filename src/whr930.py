@@ -8,16 +8,933 @@ Publish every 5 seconds the status on a MQTT topic
 Listen on MQTT topic for commands to set the ventilation level
 """
 
-import paho.mqtt.client as mqtt
+"""
+paho-mqtt and PyYAML are imported in main(), so that the command line interface
+starts fast and does not need them. The same goes for the modules that are only used by
+optional features (profiling, sinks, TLS, the HTTP API and decoding captures), they are
+imported where they are used.
+"""
 import time
 import sys
+import os
+import argparse
+import array
+import collections
+import random
+import json
+import math
+import threading
+import socket
 import serial
-import yaml
 from pathlib import Path
 
+"""
+Lookup tables used to decode the responses, created once at import so that decoding a
+response in the poll loop does not allocate new dicts or format topic strings
+"""
+TOPIC_PREFIX = "house/2/attic/wtw/"
+
+HEX = tuple("{:02x}".format(i) for i in range(256))
+
+STATUS_8BIT = tuple(
+    tuple(bool(inp & (1 << bit)) for bit in range(8)) for inp in range(256)
+)
+
+"""
+Minimal length of a valid response per command, the decoders read up to the last byte
+"""
+RESPONSE_LENGTHS = {
+    "00d1": 12,
+    "00cd": 17,
+    "000b": 13,
+    "00d9": 16,
+    "000d": 11,
+    "00df": 14,
+    "00e1": 13,
+    "00dd": 27,
+    "00d5": 18,
+    "00c9": 15,
+}
+
+INTAKE_FAN_ACTIVE = {0: False, 1: True}
+
+PREHEATING_STATUS_DATA = {
+    "PreHeatingValveStatus": {0: "Closed", 1: "Open", "2": "Unknown"},
+    "FrostProtectionActive": {0: False, 1: True},
+    "PreHeatingActive": {0: False, 1: True},
+    "FrostProtectionLevel": {
+        0: "GuaranteedProtection",
+        1: "HighProtection",
+        2: "NominalProtection",
+        3: "Economy",
+    },
+}
+
+STATUS_DATA = {
+    "PreHeatingPresent": {0: False, 1: True},
+    "ByPassPresent": {0: False, 1: True},
+    "Type": {2: "Right", 1: "Left"},
+    "Size": {1: "Large", 2: "Small"},
+    "OptionsPresent": {0: False, 1: True},
+    "EnthalpyPresent": {0: False, 1: True, 2: "PresentWithoutSensor"},
+    "EWTPresent": {0: False, 1: "Managed", 2: "Unmanaged"},
+}
+
+"""Topics of the P-states, indexed by bit number (0x01 = P10 ... 0x80 = P17)"""
+ACTIVE1_TOPICS = tuple("house/2/attic/wtw/P1{}_active".format(n) for n in range(0, 8))
+ACTIVE2_TOPICS = ("house/2/attic/wtw/P18_active", "house/2/attic/wtw/P19_active")
+ACTIVE3_TOPICS = tuple("house/2/attic/wtw/P9{}_active".format(n) for n in range(0, 8))
+
+
+class FrameSniffer:
+    """
+    Split the bytes seen on the serial line into frames, starting with 0x07 0xF0 and ending
+    with 0x07 0x0F. A 0x07 inside the data is sent twice, so 0x07 0x07 never ends a frame.
+    """
+
+    max_frame_length = 96
+
+    def __init__(self):
+        self.frame = None
+        self.previous = None
+
+    def feed(self, chunk):
+        """
+        Process the received bytes and return the completed frames
+        """
+        frames = []
+
+        for b in chunk:
+            previous = self.previous
+            self.previous = b
+
+            if previous == 0x07 and b == 0xF0:
+                """A start always begins a new frame, an incomplete frame is dropped"""
+                self.frame = bytearray(b"\x07\xf0")
+                self.previous = None
+                continue
+
+            if self.frame is None:
+                continue
+
+            self.frame.append(b)
+
+            if previous == 0x07:
+                if b == 0x07:
+                    """Escaped 0x07, the next byte can not end the frame"""
+                    self.previous = None
+                elif b == 0x0F:
+                    frames.append(bytes(self.frame))
+                    self.frame = None
+
+            if self.frame is not None and len(self.frame) > self.max_frame_length:
+                self.frame = None
+
+        return frames
+
+
+class Reading:
+    """
+    The last published value of a topic. A record is created the first time a topic is
+    published and updated in place afterwards.
+    """
+
+    __slots__ = ("topic", "name", "value", "timestamp")
+
+    def __init__(self, topic):
+        self.topic = topic
+        self.name = topic.rsplit("/", 1)[1]
+        self.value = None
+        self.timestamp = 0.0
+
+
+class OfflineBuffer:
+    """
+    Messages published while the connection with the MQTT server is down. For state topics
+    only the latest value is kept, topics listed in event_topics are kept in a bounded FIFO.
+    Messages older than max_age seconds are dropped when the buffer is flushed.
+    """
+
+    def __init__(self, max_topics=500, max_events=100, max_age=3600, event_topics=()):
+        self.max_topics = max_topics
+        self.max_age = max_age
+        self.event_topics = frozenset(event_topics)
+        self.state = {}
+        self.events = collections.deque(maxlen=max_events)
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self.state) + len(self.events)
+
+    def add(self, topic, payload):
+        now = time.monotonic()
+
+        if topic in self.event_topics:
+            if len(self.events) == self.events.maxlen:
+                self.dropped += 1
+            self.events.append((topic, payload, now))
+        else:
+            if topic in self.state:
+                """Move the topic to the end, so the oldest topic is dropped first"""
+                del self.state[topic]
+            elif len(self.state) >= self.max_topics:
+                del self.state[next(iter(self.state))]
+                self.dropped += 1
+            self.state[topic] = (payload, now)
+
+    def pop(self):
+        """
+        Return the oldest buffered (topic, payload), events first, or None when the buffer is empty
+        """
+        now = time.monotonic()
+
+        while self.events:
+            topic, payload, added = self.events.popleft()
+            if now - added <= self.max_age:
+                return topic, payload
+            self.dropped += 1
+
+        while self.state:
+            topic = next(iter(self.state))
+            payload, added = self.state.pop(topic)
+            if now - added <= self.max_age:
+                return topic, payload
+            self.dropped += 1
+
+        return None
+
+
+class BatchSink:
+    """
+    Base class of the output sinks next to MQTT. Readings are collected in memory and written
+    in batches by a background thread, as soon as batch_size readings are waiting or every
+    flush_interval seconds. When writing fails, the batch is kept for the next attempt, but
+    never more than max_pending readings. A batch the storage rejected (see rejected) is
+    dropped and counted in dropped, sending it again would fail again.
+    """
+
+    def __init__(self, batch_size=500, flush_interval=10, max_pending=50000):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.pending = []
+        self.dropped = 0
+        self.lock = threading.Lock()
+        self.event = threading.Event()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def add(self, reading):
+        with self.lock:
+            self.pending.append((reading.timestamp, reading.name, reading.value))
+            if len(self.pending) >= self.batch_size:
+                self.event.set()
+
+    def run(self):
+        while self.running:
+            self.event.wait(self.flush_interval)
+            self.event.clear()
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            batch = self.pending
+            self.pending = []
+
+        if not batch:
+            return
+
+        try:
+            self.write(batch)
+        except Exception as _err:
+            if self.rejected(_err):
+                self.dropped += len(batch)
+                warning_msg(
+                    "{} dropped {} readings that were rejected: {}".format(
+                        type(self).__name__, len(batch), _err
+                    )
+                )
+                return
+
+            warning_msg(
+                "{} could not write {} readings: {}".format(
+                    type(self).__name__, len(batch), _err
+                )
+            )
+            with self.lock:
+                self.pending = (batch + self.pending)[-self.max_pending :]
+
+    def write(self, batch):
+        raise NotImplementedError
+
+    def rejected(self, error):
+        """
+        True when the error means the batch itself is refused, not that the storage is
+        unavailable
+        """
+        return False
+
+    def close(self):
+        self.running = False
+        self.event.set()
+        self.thread.join()
+        self.flush()
+
+
+class InfluxDBSink(BatchSink):
+    """
+    Write readings in InfluxDB line protocol to the HTTP write endpoint given by url, for
+    example http://localhost:8086/api/v2/write?org=home&bucket=whr930 (InfluxDB 2) or
+    http://localhost:8086/write?db=whr930 (InfluxDB 1). Timestamps are in nanoseconds.
+    """
+
+    def __init__(self, url, token="", measurement="whr930", **kwargs):
+        self.url = url
+        self.token = token
+        self.measurement = measurement
+        super().__init__(**kwargs)
+
+    @staticmethod
+    def field(value):
+        if isinstance(value, bool):
+            return "true" if value else "false"
+        if isinstance(value, int):
+            return "{}i".format(value)
+        if isinstance(value, float):
+            return repr(value)
+        return '"{}"'.format(str(value).replace("\\", "\\\\").replace('"', '\\"'))
+
+    def write(self, batch):
+        lines = [
+            "{} {}={} {}".format(
+                self.measurement, name, self.field(value), int(timestamp * 1000000000)
+            )
+            for timestamp, name, value in batch
+        ]
+
+        import urllib.request
+
+        request = urllib.request.Request(
+            self.url, data="\n".join(lines).encode(), method="POST"
+        )
+        request.add_header("Content-Type", "text/plain; charset=utf-8")
+        if self.token:
+            request.add_header("Authorization", "Token {}".format(self.token))
+
+        with urllib.request.urlopen(request, timeout=10) as response:
+            response.read()
+
+    def rejected(self, error):
+        """
+        A 4xx response, like 400 for a bad line or a field type conflict and 401/403 for a
+        bad token, except 408 and 429 which are worth a retry. Connection errors and 5xx
+        responses are retried.
+        """
+        import urllib.error
+
+        return (
+            isinstance(error, urllib.error.HTTPError)
+            and 400 <= error.code < 500
+            and error.code not in (408, 429)
+        )
+
+
+class CSVSink(BatchSink):
+    """
+    Append readings (timestamp, name, value) to a csv file. The file is rotated when it grows
+    beyond max_bytes, keeping backup_count old files (path.1 is the newest).
+    """
+
+    def __init__(self, path, max_bytes=10485760, backup_count=5, **kwargs):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        super().__init__(**kwargs)
+
+    def rotate(self):
+        for n in range(self.backup_count - 1, 0, -1):
+            if os.path.exists("{}.{}".format(self.path, n)):
+                os.replace(
+                    "{}.{}".format(self.path, n), "{}.{}".format(self.path, n + 1)
+                )
+
+        if self.backup_count > 0:
+            os.replace(self.path, "{}.1".format(self.path))
+        else:
+            os.remove(self.path)
+
+    def write(self, batch):
+        import csv
+
+        if os.path.exists(self.path) and os.path.getsize(self.path) >= self.max_bytes:
+            self.rotate()
+
+        with open(self.path, "a", newline="") as f:
+            csv.writer(f).writerows(batch)
+
+
+class SQLiteSink(BatchSink):
+    """
+    Insert readings into the table readings (timestamp, name, value) of a SQLite database in
+    WAL mode, one transaction per batch
+    """
+
+    def __init__(self, path, **kwargs):
+        self.path = path
+        self.db = None
+        super().__init__(**kwargs)
+
+    def write(self, batch):
+        if self.db is None:
+            """The connection can only be used by the thread that created it"""
+            import sqlite3
+
+            self.db = sqlite3.connect(self.path)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS readings (timestamp REAL, name TEXT, value)"
+            )
+
+        with self.db:
+            self.db.executemany("INSERT INTO readings VALUES (?, ?, ?)", batch)
+
+
+SINK_TYPES = {"influxdb": InfluxDBSink, "csv": CSVSink, "sqlite": SQLiteSink}
+
+
+def create_sink(config):
+    config = dict(config)
+    return SINK_TYPES[config.pop("type")](**config)
+
+
+class ResumingSSLContext:
+    """
+    TLS context that offers the session of the previous connection, so a reconnect skips
+    the full handshake when the server supports session resumption. Mixed into
+    ssl.SSLContext by create_tls_context, so ssl is only imported when TLS is used.
+    """
+
+    session = None
+
+    def wrap_socket(self, sock, *args, **kwargs):
+        if self.session is not None:
+            kwargs.setdefault("session", self.session)
+
+        return super().wrap_socket(sock, *args, **kwargs)
+
+
+def create_tls_context():
+    import ssl
+
+    context_class = type("ResumingSSLContext", (ResumingSSLContext, ssl.SSLContext), {})
+    return context_class(ssl.PROTOCOL_TLS_CLIENT)
+
+
+class Broker:
+    """
+    A MQTT server the readings are published to, with its own client, topic prefix, TLS
+    settings and outbound queue. Messages are published from a background thread, so a slow
+    or unreachable server never delays the poll loop or the other servers. Messages published
+    while the server is unreachable go into the offline buffer of the server.
+
+    Commands are only received from the primary server. With session_expiry the server keeps
+    the session, with the subscriptions and the QoS 1 commands that arrive while the bridge
+    is disconnected, for that many seconds (MQTT v5, MQTT 3 servers keep it until it is
+    cleaned).
+    """
+
+    def __init__(self, config, client_id="whr930", primary=False):
+        import paho.mqtt.client as mqtt
+
+        tls = config.get("tls")
+        if tls is True:
+            tls = {}
+        elif not isinstance(tls, dict):
+            tls = None
+
+        self.server = config["server"]
+        self.port = config.get("port") or (1883 if tls is None else 8883)
+        self.topic_prefix = config.get("topic_prefix", TOPIC_PREFIX)
+        self.protocol = config.get("protocol", 3)
+        self.publish_interval = config.get("publish_interval", 0.1)
+        self.session_expiry = config.get("session_expiry", 0)
+        self.subscribed = False
+        self.tls_context = None
+        self.primary = primary
+        self.connected = False
+        self.topics = {}
+        self.topic_aliases = {}
+        self.topic_alias_maximum = 0
+        self.alias_lock = threading.Lock()
+        self.properties = {}
+        self.profiler = None
+        self.queue = collections.deque(maxlen=config.get("queue_size", 1000))
+        self.dropped = 0
+        self.offline_buffer = OfflineBuffer(**offline_buffer_config)
+        self.event = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+        client_id = config.get("client_id", client_id)
+        if self.protocol == 5:
+            from paho.mqtt.properties import Properties
+            from paho.mqtt.packettypes import PacketTypes
+
+            self.Properties = Properties
+            self.publish_packet = PacketTypes.PUBLISH
+            self.client = mqtt.Client(client_id, protocol=mqtt.MQTTv5)
+        else:
+            self.client = mqtt.Client(client_id, clean_session=self.session_expiry == 0)
+
+        self.client.username_pw_set(
+            username=config.get("username"), password=config.get("password")
+        )
+
+        if tls is not None:
+            self.tls_context = create_tls_context()
+            if tls.get("ca_certs") is not None:
+                self.tls_context.load_verify_locations(tls["ca_certs"])
+            else:
+                self.tls_context.load_default_certs()
+            if tls.get("certfile") is not None:
+                self.tls_context.load_cert_chain(tls["certfile"], tls.get("keyfile"))
+
+            self.client.tls_set_context(self.tls_context)
+            self.client.tls_insecure_set(tls.get("insecure", False))
+
+        self.client.on_connect = self.on_connect
+        self.client.on_disconnect = self.on_disconnect
+        if primary is True:
+            self.client.on_message = on_message
+            self.client.on_publish = on_publish
+
+    def start(self):
+        """
+        The bridge does not start without the primary server, the other servers are
+        connected in the background
+        """
+        options = {}
+        if self.protocol == 5 and self.session_expiry > 0:
+            from paho.mqtt.properties import Properties
+            from paho.mqtt.packettypes import PacketTypes
+
+            properties = Properties(PacketTypes.CONNECT)
+            properties.SessionExpiryInterval = self.session_expiry
+            options = {"clean_start": False, "properties": properties}
+
+        if self.primary is True:
+            self.client.connect(self.server, port=self.port, keepalive=45, **options)
+        else:
+            self.client.connect_async(
+                self.server, port=self.port, keepalive=45, **options
+            )
+
+        self.client.loop_start()
+        self.thread.start()
+
+    def stop(self):
+        self.client.loop_stop()
+
+    def publish(self, topic, payload, trace=None):
+        """
+        Queue a message, when the queue is full the oldest message is dropped
+        """
+        if len(self.queue) == self.queue.maxlen:
+            self.dropped += 1
+
+        self.queue.append((topic, payload, trace))
+        self.event.set()
+
+    def run(self):
+        while True:
+            self.event.wait()
+            self.event.clear()
+            self.profiler = profile_thread(self.profiler)
+
+            if self.connected is True and len(self.offline_buffer) > 0:
+                self.flush_offline_buffer()
+
+            while self.queue:
+                self.profiler = profile_thread(self.profiler)
+                topic, payload, trace = self.queue.popleft()
+
+                """Queued by poll after the last message of a traced frame"""
+                if topic is None:
+                    close_trace(trace)
+                    continue
+
+                if self.connected is False:
+                    self.offline_buffer.add(topic, payload)
+                    continue
+
+                info = self.send(topic, payload)
+                if trace is not None and self.primary is True:
+                    track_publish(trace, info)
+                time.sleep(self.publish_interval)
+
+    def flush_offline_buffer(self):
+        """
+        Publish the messages buffered during an outage, limited to offline_flush_rate
+        messages per second so the server is not flooded on recovery
+        """
+        info_msg(
+            "Publishing {} buffered messages to {} ({} dropped during the outage)".format(
+                len(self.offline_buffer), self.server, self.offline_buffer.dropped
+            )
+        )
+        self.offline_buffer.dropped = 0
+
+        while self.connected is True:
+            message = self.offline_buffer.pop()
+            if message is None:
+                break
+
+            topic, payload = message
+            self.send(topic, payload)
+            time.sleep(1.0 / offline_flush_rate)
+
+    def send(self, topic, payload):
+        """
+        Publish using the QoS, retain flag and message expiry from the topic policy. With
+        MQTT v5 a topic alias is assigned to each QoS 0 topic as long as the server allows it,
+        after which the alias is sent instead of the full topic. QoS 1 and 2 messages always
+        carry the full topic and no alias: paho resends them after a reconnect, when the
+        aliases of the previous connection are no longer known to the server. The aliases
+        are read and used under alias_lock, so a reconnect can not clear them in between.
+        """
+        qos, retain, expiry = mqtt_policy.get(topic, mqtt_default_policy)
+
+        full_topic = self.topics.get(topic)
+        if full_topic is None:
+            if topic.startswith(TOPIC_PREFIX):
+                full_topic = self.topic_prefix + topic[len(TOPIC_PREFIX) :]
+            else:
+                full_topic = topic
+            self.topics[topic] = full_topic
+
+        if self.protocol != 5:
+            return self.client.publish(
+                full_topic, payload=payload, qos=qos, retain=retain
+            )
+
+        with self.alias_lock:
+            alias = self.topic_aliases.get(full_topic) if qos == 0 else None
+            if alias is not None:
+                try:
+                    return self.client.publish(
+                        "",
+                        payload=payload,
+                        qos=qos,
+                        retain=retain,
+                        properties=self.publish_properties(expiry, alias),
+                    )
+                except ValueError:
+                    warning_msg(
+                        "Publishing by topic alias failed, topic aliases disabled"
+                    )
+                    self.clear_aliases()
+                    alias = None
+            elif qos == 0 and len(self.topic_aliases) < self.topic_alias_maximum:
+                alias = len(self.topic_aliases) + 1
+                self.topic_aliases[full_topic] = alias
+
+            return self.client.publish(
+                full_topic,
+                payload=payload,
+                qos=qos,
+                retain=retain,
+                properties=self.publish_properties(expiry, alias),
+            )
+
+    def publish_properties(self, expiry, alias):
+        """
+        The PUBLISH properties for a message expiry and topic alias, created once and
+        reused, None when there are none
+        """
+        if expiry == 0 and alias is None:
+            return None
+
+        properties = self.properties.get((expiry, alias))
+        if properties is None:
+            properties = self.Properties(self.publish_packet)
+            if expiry > 0:
+                properties.MessageExpiryInterval = expiry
+            if alias is not None:
+                properties.TopicAlias = alias
+            self.properties[(expiry, alias)] = properties
+
+        return properties
+
+    def clear_aliases(self, maximum=0):
+        """Topic aliases are only valid for a single connection"""
+        self.topic_aliases.clear()
+        self.topic_alias_maximum = maximum
+
+    def on_connect(self, client, userdata, flags, rc, properties=None):
+        with self.alias_lock:
+            self.clear_aliases(getattr(properties, "TopicAliasMaximum", 0))
+
+        if rc == 0:
+            self.connected = True
+            self.event.set()
+
+            if self.tls_context is not None:
+                sock = client.socket()
+                debug_msg("TLS session reused: {}", sock.session_reused)
+                self.tls_context.session = sock.session
+
+        if self.primary is True:
+            """The server kept our subscriptions when it resumed the session"""
+            if self.subscribed is True and flags.get("session present"):
+                debug_msg("Session resumed, keeping the subscriptions")
+            else:
+                topic_subscribe(client)
+                self.subscribed = rc == 0
+
+    def on_disconnect(self, client, userdata, rc, properties=None):
+        """Before reconnecting, so no alias of this connection is used on the next one"""
+        with self.alias_lock:
+            self.clear_aliases()
+        self.connected = False
+
+        if rc != 0:
+            warning_msg(
+                "Unexpected disconnection from MQTT server {}, trying to reconnect".format(
+                    self.server
+                )
+            )
+            self.reconnect()
+
+    def reconnect(self):
+        while True:
+            try:
+                self.client.reconnect()
+                info_msg(
+                    "Successfull reconnected to the MQTT server {}".format(self.server)
+                )
+                return
+            except Exception:
+                warning_msg(
+                    "Could not reconnect to the MQTT server {}. Trying again in 10 seconds".format(
+                        self.server
+                    )
+                )
+                time.sleep(10)
+
+
+class StateRequestHandler:
+    """
+    Read-only HTTP/JSON API on the last published values, served from memory without
+    touching the serial port:
+
+        GET /state         : all readings
+        GET /state/<name>  : a single reading, for example /state/comfort_temp
+
+    Each reading has its value, the time it was published and a stale flag, set when it
+    was not updated for http_stale_after seconds. Responses carry an ETag, a request with
+    a matching If-None-Match gets a 304 Not Modified.
+
+    Mixed into http.server.BaseHTTPRequestHandler by start_http_server, so http.server is
+    only imported when the API is enabled.
+    """
+
+    cache = {}
+
+    def do_GET(self):
+        path = self.path.split("?", 1)[0].rstrip("/")
+
+        if path in ("", "/state"):
+            name = None
+        elif path.startswith("/state/"):
+            name = path[len("/state/") :]
+        else:
+            self.send_error(404)
+            return
+
+        now = time.time()
+        selected = [
+            reading
+            for reading in list(readings.values())
+            if name is None or reading.name == name
+        ]
+        if not selected:
+            self.send_error(404)
+            return
+
+        """
+        Between two updates readings can only become stale, so the version and the number
+        of stale readings identify the response
+        """
+        stale = sum(
+            1 for reading in selected if now - reading.timestamp > http_stale_after
+        )
+        etag = '"{}-{}"'.format(state_version, stale)
+
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+
+        key = (name, etag)
+        body = self.cache.get(key)
+        if body is None:
+            body = json.dumps(
+                {
+                    reading.name: {
+                        "value": reading.value,
+                        "timestamp": reading.timestamp,
+                        "stale": now - reading.timestamp > http_stale_after,
+                    }
+                    for reading in selected
+                }
+            ).encode()
+            if len(self.cache) > 100:
+                self.cache.clear()
+            self.cache[key] = body
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        debug_msg("HTTP {} {}", self.address_string(), format % args)
+
+
+def start_http_server(address, port):
+    import http.server
+
+    handler = type(
+        "StateRequestHandler",
+        (StateRequestHandler, http.server.BaseHTTPRequestHandler),
+        {},
+    )
+    server = http.server.ThreadingHTTPServer((address, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    info_msg("Serving the state on http://{}:{}/state".format(address, port))
+    return server
+
+
+class Trace:
+    """
+    Timestamps (time.monotonic) of a single frame: writing the command, the first and the
+    last byte of the response, the end of the response wait, decoding done and the
+    acknowledgement by the primary MQTT server of the last message published from the frame.
+    sent and acks count the messages of the frame, closed is set when the last one was sent.
+    """
+
+    __slots__ = (
+        "seq",
+        "command",
+        "write",
+        "first_byte",
+        "complete",
+        "read",
+        "decoded",
+        "acked",
+        "sent",
+        "acks",
+        "closed",
+    )
 
-def debug_msg(message):
+    def __init__(self, seq, command):
+        self.seq = seq
+        self.command = command
+        self.write = time.monotonic()
+        self.first_byte = 0.0
+        self.complete = 0.0
+        self.read = 0.0
+        self.decoded = 0.0
+        self.acked = 0.0
+        self.sent = 0
+        self.acks = 0
+        self.closed = False
+
+
+"""Name, start and end of each traced stage"""
+TRACE_STAGES = (
+    ("serial", "write", "first_byte"),
+    ("receive", "first_byte", "complete"),
+    ("settle", "complete", "read"),
+    ("decode", "read", "decoded"),
+    ("publish", "decoded", "acked"),
+    ("total", "write", "acked"),
+)
+
+tracing = False
+trace_frames = False
+trace_summary_every = 100
+trace_seq = 0
+trace_count = 0
+current_trace = None
+trace_pending = {}
+trace_expiry = 60
+trace_lock = threading.Lock()
+trace_durations = {
+    name: collections.deque(maxlen=1000) for name, start, end in TRACE_STAGES
+}
+
+
+filters = {}
+filter_counts = collections.Counter()
+
+readings = {}
+state_version = 0
+state_segment = None
+http_stale_after = 120
+
+debug = False
+debug_level = 0
+warning = False
+brokers = []
+mqtt_policy = {}
+mqtt_default_policy = (0, True, 0)
+offline_buffer_config = {}
+offline_flush_rate = 20
+ser = None
+pending_commands = []
+wakeup = threading.Event()
+sinks = []
+rules = []
+sniffer = FrameSniffer()
+last_seen = {}
+thread_profilers = {}
+passive = False
+passive_listen = 5
+passive_gap = 60
+cycle_budget = 120
+serial_stats = {"frames": 0, "errors": 0, "retries": 0, "failures": 0, "resets": 0}
+retry_default = (3, 0.2, 0.3)
+retry_policy = {}
+retry_reset_after = 5
+consecutive_failures = 0
+systemd_ready = False
+refresh_requests = set()
+refresh_due = None
+refresh_window = 0.5
+refresh_min_interval = 2
+rules_level = None
+rules_release_level = 2
+rules_failures = 0
+rules_retry_at = 0.0
+rules_retry_min = 10
+rules_retry_max = 600
+
+
+def debug_msg(message, *args):
+    """
+    The message is only formatted with args when debugging is enabled
+    """
     if debug is True:
+        if args:
+            message = message.format(*args)
+
         print(
             "{0} DEBUG: {1}".format(
                 time.strftime("%d-%m-%Y %H:%M:%S", time.gmtime()), message
@@ -52,59 +969,183 @@ def debug_data(serial_data):
             data_len = len(serial_data)
             if data_len == 2 and serial_data[0] == "07" and serial_data[1] == "f3":
                 debug_msg(
-                    "Recieved an ack packet: {0} {1}".format(
-                        serial_data[0], serial_data[1]
-                    )
+                    "Recieved an ack packet: {0} {1}", serial_data[0], serial_data[1]
                 )
             else:
-                debug_msg("Data length   : {0}".format(len(serial_data)))
-                debug_msg(
-                    "Ack           : {0} {1}".format(serial_data[0], serial_data[1])
-                )
-                debug_msg(
-                    "Start         : {0} {1}".format(serial_data[2], serial_data[3])
-                )
-                debug_msg(
-                    "Command       : {0} {1}".format(serial_data[4], serial_data[5])
-                )
+                debug_msg("Data length   : {0}", len(serial_data))
+                debug_msg("Ack           : {0} {1}", serial_data[0], serial_data[1])
+                debug_msg("Start         : {0} {1}", serial_data[2], serial_data[3])
+                debug_msg("Command       : {0} {1}", serial_data[4], serial_data[5])
                 debug_msg(
-                    "Nr data bytes : {0} (integer {1})".format(
-                        serial_data[6], int(serial_data[6], 16)
-                    )
+                    "Nr data bytes : {0} (integer {1})",
+                    serial_data[6],
+                    int(serial_data[6], 16),
                 )
 
                 n = 1
                 while n <= int(serial_data[6], 16):
                     debug_msg(
-                        "Data byte {0}   : Hex: {1}, Int: {2}, Array #: {3}".format(
-                            n, serial_data[n + 6], int(serial_data[n + 6], 16), n + 6
-                        )
+                        "Data byte {0}   : Hex: {1}, Int: {2}, Array #: {3}",
+                        n,
+                        serial_data[n + 6],
+                        int(serial_data[n + 6], 16),
+                        n + 6,
                     )
                     n += 1
 
-                debug_msg("Checksum      : {0}".format(serial_data[-2]))
-                debug_msg(
-                    "End           : {0} {1}".format(serial_data[-2], serial_data[-1])
-                )
+                debug_msg("Checksum      : {0}", serial_data[-2])
+                debug_msg("End           : {0} {1}", serial_data[-2], serial_data[-1])
 
         if debug_level > 1:
             n = 0
             while n < data_len:
-                debug_msg("serial_data {0}   : {1}".format(n, serial_data[n]))
+                debug_msg("serial_data {0}   : {1}", n, serial_data[n])
                 n += 1
 
     else:
         debug_msg("serial_data is empty")
 
 
+def record_reading(msg, mqtt_path):
+    global state_version
+
+    reading = readings.get(mqtt_path)
+    if reading is None:
+        reading = readings[mqtt_path] = Reading(mqtt_path)
+
+    state_version += 1
+    reading.value = msg
+    reading.timestamp = time.time()
+
+    return reading
+
+
+def load_filters(config):
+    """
+    Plausibility filters per reading name. A value outside min and max is always dropped,
+    also with action flag. A value that differs more than max_deviation from the median of
+    the last window values, or changes faster than max_rate per second compared to the last
+    accepted value, is suspicious: it is only accepted when it is confirmed by the next
+    confirm - 1 values, so a real change comes through and a single spike does not.
+    Suspicious values are dropped (action suppress) or published and flagged (action flag).
+    """
+    loaded = {}
+
+    for name, settings in config.items():
+        loaded[name] = {
+            "min": settings.get("min"),
+            "max": settings.get("max"),
+            "max_rate": settings.get("max_rate"),
+            "max_deviation": settings.get("max_deviation"),
+            "window": collections.deque(maxlen=settings.get("window", 5)),
+            "confirm": settings.get("confirm", 3),
+            "action": settings.get("action", "suppress"),
+            "last": None,
+            "last_time": 0.0,
+            "rejected": 0,
+        }
+
+    return loaded
+
+
+def filter_reading(name, value):
+    """
+    Check a value against the filter of its name, returns the action and the reason when
+    it is implausible, or None. Updates take constant time, the median is taken over at
+    most window values.
+    """
+    settings = filters.get(name)
+    if (
+        settings is None
+        or isinstance(value, bool)
+        or not isinstance(value, (int, float))
+    ):
+        return None
+
+    if settings["min"] is not None and value < settings["min"]:
+        return "suppress", "below {}".format(settings["min"])
+    if settings["max"] is not None and value > settings["max"]:
+        return "suppress", "above {}".format(settings["max"])
+
+    now = time.monotonic()
+    reason = None
+    window = settings["window"]
+
+    if settings["max_deviation"] is not None and len(window) == window.maxlen:
+        median = sorted(window)[len(window) // 2]
+        if abs(value - median) > settings["max_deviation"]:
+            reason = "{} from median {}".format(value - median, median)
+
+    last = settings["last"]
+    if reason is None and settings["max_rate"] is not None and last is not None:
+        rate = abs(value - last) / max(now - settings["last_time"], 1.0)
+        if rate > settings["max_rate"]:
+            reason = "changed {:.2f} per second".format(rate)
+
+    """Rejected values are kept in the window, so the median follows a real change"""
+    window.append(value)
+
+    if reason is not None:
+        settings["rejected"] += 1
+        if settings["rejected"] < settings["confirm"]:
+            return settings["action"], reason
+
+    settings["rejected"] = 0
+    settings["last"] = value
+    settings["last_time"] = now
+    return None
+
+
 def publish_message(msg, mqtt_path):
-    mqttc.publish(mqtt_path, payload=msg, qos=0, retain=True)
-    time.sleep(0.1)
-    debug_msg(
-        "published message {0} on topic {1} at {2}".format(
-            msg, mqtt_path, time.asctime(time.localtime(time.time()))
+    if filters:
+        name = mqtt_path.rsplit("/", 1)[1]
+        implausible = filter_reading(name, msg)
+
+        if implausible is not None:
+            action, reason = implausible
+            filter_counts[name] += 1
+            warning_msg("Implausible {} {}: {}".format(name, msg, reason))
+
+            if action != "flag":
+                return
+
+            publish_message(
+                msg=json.dumps({"name": name, "value": msg, "reason": reason}),
+                mqtt_path="house/2/attic/wtw/outlier",
+            )
+
+    reading = record_reading(msg, mqtt_path)
+
+    if state_segment is not None:
+        if state_segment.update(reading.name, msg, reading.timestamp) is False:
+            warning_msg(
+                "{} is not in the shared memory state, the name is too long or there "
+                "are not enough shm_slots".format(reading.name)
+            )
+
+    trace = current_trace
+    if trace is not None and trace.decoded == 0.0:
+        trace.decoded = time.monotonic()
+
+    for sink in sinks:
+        sink.add(reading)
+
+    if not brokers:
+        """Used from the command line interface, only record the reading"""
+        return
+
+    """Serialize the payload once, the same way paho-mqtt does, for all servers"""
+    payload = str(msg).encode()
+    for broker in brokers:
+        broker.publish(mqtt_path, payload, trace)
+
+    if debug is True:
+        debug_msg(
+            "published message {0} on topic {1} at {2}",
+            msg,
+            mqtt_path,
+            time.asctime(time.localtime(time.time())),
         )
-    )
 
 
 def create_packet(command, data=[]):
@@ -174,7 +1215,7 @@ def validate_data(data_raw):
     """Incoming data is in raw bytes. Convert to hex values for easier processing"""
     data = []
     for raw in data_raw:
-        data.append(raw.hex())
+        data.append(HEX[raw[0]])
 
     if len(data) <= 1:
         """always expect a valid ACK at least"""
@@ -205,14 +1246,14 @@ def validate_data(data_raw):
             """
             dataset_len = int(data[6], 16)
             message_len = dataset_len + 10
-            debug_msg("Message length is {}".format(message_len))
+            debug_msg("Message length is {}", message_len)
 
             """
             Sometimes more data is captured on the serial port then we expect. We drop those extra
             bytes to get a clean data to work on
             """
             stripped_data = data[0:message_len]
-            debug_msg("Stripped message length is {}".format(len(stripped_data)))
+            debug_msg("Stripped message length is {}", len(stripped_data))
 
             if (
                 stripped_data[0] != "07"
@@ -261,34 +1302,227 @@ def validate_data(data_raw):
             return None
 
 
-def serial_command(cmd):
-    data = []
-    ser.write(cmd)
-    time.sleep(2)
+def reset_serial():
+    """
+    Close and reopen the serial port, used when commands keep failing
+    """
+    serial_stats["resets"] += 1
+    warning_msg("Too many failed commands, resetting the serial port")
 
-    while ser.inWaiting() > 0:
-        data.append(ser.read(1))
+    try:
+        ser.close()
+        ser.open()
+    except serial.SerialException as _err:
+        warning_msg("Could not reopen the serial port: {}".format(_err))
 
-    return validate_data(data)
 
+def serial_command(cmd):
+    """
+    Send a command and return the validated response. An invalid or incomplete response is
+    retried immediately, after a short jittered delay, with the attempts from the retry policy
+    of the command. After retry_reset_after failed commands in a row the port is reset.
+    Like decode_frame, a valid reply updates last_seen of its command.
+    """
+    global consecutive_failures
+    global current_trace
+    global trace_seq
+
+    command = HEX[cmd[2]] + HEX[cmd[3]]
+    attempts, delay, jitter = retry_policy.get(command, retry_default)
+    min_length = RESPONSE_LENGTHS.get(command, 0)
+
+    for attempt in range(attempts):
+        if attempt > 0:
+            serial_stats["retries"] += 1
+            time.sleep(delay + random.uniform(0, jitter))
+            debug_msg("Retry {} of command {}", attempt, command)
+
+        data = []
+        ser.reset_input_buffer()
+        ser.write(cmd)
+
+        if tracing is True:
+            trace_seq += 1
+            current_trace = Trace(trace_seq, command)
+            wait_traced(current_trace, 2)
+        else:
+            time.sleep(2)
 
-def status_8bit(inp):
+        while ser.inWaiting() > 0:
+            data.append(ser.read(1))
+
+        data = validate_data(data)
+        if data is not None and len(data) >= min_length:
+            serial_stats["frames"] += 1
+            consecutive_failures = 0
+            if len(data) >= 10:
+                last_seen[data[4] + data[5]] = time.monotonic()
+            return data
+
+        serial_stats["errors"] += 1
+        current_trace = None
+
+    serial_stats["failures"] += 1
+    consecutive_failures += 1
+    if consecutive_failures >= retry_reset_after:
+        consecutive_failures = 0
+        reset_serial()
+
+    return None
+
+
+def wait_traced(trace, seconds):
     """
-    Return the status of each bit in a 8 byte status
+    Wait for the response like serial_command does, but watch the serial port to record
+    when the first and the last byte arrived
     """
-    idx = 7
-    matches = {}
+    deadline = trace.write + seconds
+    seen = 0
 
-    for num in (2**p for p in range(idx, -1, -1)):
-        if ((inp - num) > 0) or ((inp - num) == 0):
-            inp = inp - num
-            matches[idx] = True
-        else:
-            matches[idx] = False
+    while True:
+        now = time.monotonic()
+        if now >= deadline:
+            break
+
+        waiting = ser.inWaiting()
+        if waiting > seen:
+            if seen == 0:
+                trace.first_byte = now
+            trace.complete = now
+            seen = waiting
+
+        time.sleep(0.005)
+
+    trace.read = time.monotonic()
+
+
+def track_publish(trace, info):
+    """
+    Remember the message id of every message published for a traced frame, so the trace
+    is finished when the MQTT server acknowledged all of them
+    """
+    if info is None:
+        return
+
+    with trace_lock:
+        trace.sent += 1
+
+        if len(trace_pending) > 100:
+            """Messages that were never acknowledged, for example lost on a reconnect"""
+            expired = time.monotonic() - trace_expiry
+            for mid in [
+                mid for mid, pending in trace_pending.items() if pending.write < expired
+            ]:
+                del trace_pending[mid]
+        trace_pending[info.mid] = trace
 
-        idx -= 1
+    """QoS 0 messages can already be published before we get the message id"""
+    if info.is_published():
+        on_publish(None, None, info.mid)
 
-    return matches
+
+def on_publish(client, userdata, mid):
+    """
+    Called from the paho thread, and from the broker thread by track_publish
+    """
+    with trace_lock:
+        trace = trace_pending.pop(mid, None)
+        if trace is None:
+            return
+
+        trace.acks += 1
+        done = trace.closed is True and trace.acks == trace.sent
+
+    if done is True:
+        trace.acked = time.monotonic()
+        finish_trace(trace)
+
+
+def close_trace(trace):
+    """
+    All messages of the frame are sent, finish the trace when they are all acknowledged
+    """
+    with trace_lock:
+        trace.closed = True
+        done = trace.sent > 0 and trace.acks == trace.sent
+
+    if done is True:
+        trace.acked = time.monotonic()
+        finish_trace(trace)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[int(round(p / 100.0 * (len(values) - 1)))]
+
+
+def finish_trace(trace):
+    """
+    Record the duration of each stage of a finished trace. Every trace_summary_every traces
+    the p50, p90 and p99 per stage in milliseconds are logged and published on
+    house/2/attic/wtw/trace/summary, with trace_frames every trace is published on
+    house/2/attic/wtw/trace.
+    """
+    global trace_count
+
+    stages = {}
+    for name, start, end in TRACE_STAGES:
+        begin = getattr(trace, start)
+        finish = getattr(trace, end)
+        if begin > 0 and finish > 0:
+            stages[name] = round((finish - begin) * 1000, 1)
+            trace_durations[name].append(stages[name])
+
+    if trace_frames is True:
+        payload = json.dumps(
+            {"seq": trace.seq, "command": trace.command, "stages": stages}
+        ).encode()
+        for broker in brokers:
+            broker.publish("house/2/attic/wtw/trace", payload)
+
+    trace_count += 1
+    if trace_count % trace_summary_every != 0:
+        return
+
+    summary = {
+        name: {
+            "p50": percentile(durations, 50),
+            "p90": percentile(durations, 90),
+            "p99": percentile(durations, 99),
+        }
+        for name, durations in trace_durations.items()
+        if durations
+    }
+    info_msg("Latency per stage in ms: {}".format(summary))
+
+    payload = json.dumps(summary).encode()
+    for broker in brokers:
+        broker.publish("house/2/attic/wtw/trace/summary", payload)
+
+
+def publish_serial_stats():
+    publish_message(
+        msg=serial_stats["retries"], mqtt_path="house/2/attic/wtw/serial_retries"
+    )
+    publish_message(
+        msg=serial_stats["failures"], mqtt_path="house/2/attic/wtw/serial_failures"
+    )
+    publish_message(
+        msg=serial_stats["resets"], mqtt_path="house/2/attic/wtw/serial_resets"
+    )
+
+    if filters:
+        publish_message(
+            msg=sum(filter_counts.values()),
+            mqtt_path="house/2/attic/wtw/filtered_readings",
+        )
+
+
+def status_8bit(inp):
+    """
+    Return the status of each bit in a 8 byte status, indexed by bit number
+    """
+    return STATUS_8BIT[inp & 0xFF]
 
 
 def set_ventilation_level(fan_level):
@@ -310,6 +1544,7 @@ def set_ventilation_level(fan_level):
     if data:
         if data[0] == "07" and data[1] == "f3":
             info_msg("Changed the ventilation to {0}".format(fan_level))
+            return True
         else:
             warning_msg(
                 "Changing the ventilation to {0} went wrong, did not receive an ACK after the set command".format(
@@ -345,6 +1580,7 @@ def set_comfort_temperature(temperature):
     if data:
         if data[0] == "07" and data[1] == "f3":
             info_msg("Changed comfort temperature to {0}".format(temperature))
+            return True
         else:
             warning_msg(
                 "Changing the comfort temperature to {0} went wrong, did not receive an ACK after the set command".format(
@@ -377,13 +1613,16 @@ def set_default_fan_speed_levels():
     """
 
     # 15 35 50 15 35 50 70 70 0
-    packet = create_packet([0x00, 0xCF], [0x0F, 0x23, 0x32, 0x0F, 0x23, 0x32, 0x46, 0x46, 0x00])
+    packet = create_packet(
+        [0x00, 0xCF], [0x0F, 0x23, 0x32, 0x0F, 0x23, 0x32, 0x46, 0x46, 0x00]
+    )
     data = serial_command(packet)
     debug_data(data)
 
     if data:
         if data[0] == "07" and data[1] == "f3":
             info_msg("Changed fan speed levels")
+            return True
         else:
             warning_msg(
                 "Changing the fan speed levels went wrong, did not receive an ACK after the set command"
@@ -394,12 +1633,14 @@ def set_default_fan_speed_levels():
         )
 
 
-def get_temp():
+def get_temp(data=None):
     """
     Command: 0x00 0xD1
     """
-    packet = create_packet([0x00, 0xD1])
-    data = serial_command(packet)
+    if data is None:
+        packet = create_packet([0x00, 0xD1])
+        data = serial_command(packet)
+
     debug_data(data)
 
     try:
@@ -433,26 +1674,25 @@ def get_temp():
             )
 
             debug_msg(
-                "ComfortTemp: {0}, OutsideAirTemp: {1}, SupplyAirTemp: {2}, ReturnAirTemp: {3}, ExhaustAirTemp: {4}".format(
-                    ComfortTemp,
-                    OutsideAirTemp,
-                    SupplyAirTemp,
-                    ReturnAirTemp,
-                    ExhaustAirTemp,
-                )
+                "ComfortTemp: {0}, OutsideAirTemp: {1}, SupplyAirTemp: {2}, ReturnAirTemp: {3}, ExhaustAirTemp: {4}",
+                ComfortTemp,
+                OutsideAirTemp,
+                SupplyAirTemp,
+                ReturnAirTemp,
+                ExhaustAirTemp,
             )
     except IndexError:
         warning_msg("get_temp ignoring incomplete message")
 
 
-def get_ventilation_status():
+def get_ventilation_status(data=None):
     """
     Command: 0x00 0xCD
     """
-    status_data = {"IntakeFanActive": {0: False, 1: True}}
+    if data is None:
+        packet = create_packet([0x00, 0xCD])
+        data = serial_command(packet)
 
-    packet = create_packet([0x00, 0xCD])
-    data = serial_command(packet)
     debug_data(data)
 
     try:
@@ -462,7 +1702,7 @@ def get_ventilation_status():
             ReturnAirLevel = int(data[13], 16)
             SupplyAirLevel = int(data[14], 16)
             FanLevel = int(data[15], 16) - 1
-            IntakeFanActive = status_data["IntakeFanActive"][int(data[16], 16)]
+            IntakeFanActive = INTAKE_FAN_ACTIVE[int(data[16], 16)]
 
             publish_message(
                 msg=ReturnAirLevel, mqtt_path="house/2/attic/wtw/return_air_level"
@@ -477,20 +1717,24 @@ def get_ventilation_status():
                 msg=IntakeFanActive, mqtt_path="house/2/attic/wtw/intake_fan_active"
             )
             debug_msg(
-                "ReturnAirLevel: {}, SupplyAirLevel: {}, FanLevel: {}, IntakeFanActive: {}".format(
-                    ReturnAirLevel, SupplyAirLevel, FanLevel, IntakeFanActive
-                )
+                "ReturnAirLevel: {}, SupplyAirLevel: {}, FanLevel: {}, IntakeFanActive: {}",
+                ReturnAirLevel,
+                SupplyAirLevel,
+                FanLevel,
+                IntakeFanActive,
             )
     except IndexError:
         warning_msg("get_ventilation_status ignoring incomplete message")
 
 
-def get_fan_status():
+def get_fan_status(data=None):
     """
     Command: 0x00 0x0B
     """
-    packet = create_packet([0x00, 0x0B])
-    data = serial_command(packet)
+    if data is None:
+        packet = create_packet([0x00, 0x0B])
+        data = serial_command(packet)
+
     debug_data(data)
 
     try:
@@ -499,8 +1743,12 @@ def get_fan_status():
         else:
             IntakeFanSpeed = int(data[7], 16)
             ExhaustFanSpeed = int(data[8], 16)
-            IntakeFanRPM = int(1875000 / (int(data[9], 16) * 256 + int(data[10], 16)))
-            ExhaustFanRPM = int(1875000 / (int(data[11], 16) * 256 + int(data[12], 16)))
+            IntakeFanPeriod = int(data[9], 16) * 256 + int(data[10], 16)
+            ExhaustFanPeriod = int(data[11], 16) * 256 + int(data[12], 16)
+
+            """A period of 0 is reported when the fan stands still"""
+            IntakeFanRPM = int(1875000 / IntakeFanPeriod) if IntakeFanPeriod else 0
+            ExhaustFanRPM = int(1875000 / ExhaustFanPeriod) if ExhaustFanPeriod else 0
 
             publish_message(
                 msg=IntakeFanSpeed, mqtt_path="house/2/attic/wtw/intake_fan_speed"
@@ -516,20 +1764,24 @@ def get_fan_status():
             )
 
             debug_msg(
-                "IntakeFanSpeed {0}%, ExhaustFanSpeed {1}%, IntakeAirRPM {2}, ExhaustAirRPM {3}".format(
-                    IntakeFanSpeed, ExhaustFanSpeed, IntakeFanRPM, ExhaustFanRPM
-                )
+                "IntakeFanSpeed {0}%, ExhaustFanSpeed {1}%, IntakeAirRPM {2}, ExhaustAirRPM {3}",
+                IntakeFanSpeed,
+                ExhaustFanSpeed,
+                IntakeFanRPM,
+                ExhaustFanRPM,
             )
     except IndexError:
         warning_msg("get_fan_status ignoring incomplete message")
 
 
-def get_filter_status():
+def get_filter_status(data=None):
     """
     Command: 0x00 0xD9
     """
-    packet = create_packet([0x00, 0xD9])
-    data = serial_command(packet)
+    if data is None:
+        packet = create_packet([0x00, 0xD9])
+        data = serial_command(packet)
+
     debug_data(data)
 
     try:
@@ -546,17 +1798,19 @@ def get_filter_status():
             publish_message(
                 msg=FilterStatus, mqtt_path="house/2/attic/wtw/filter_status"
             )
-            debug_msg("FilterStatus: {0}".format(FilterStatus))
+            debug_msg("FilterStatus: {0}", FilterStatus)
     except IndexError:
         warning_msg("get_filter_status ignoring incomplete message")
 
 
-def get_valve_status():
+def get_valve_status(data=None):
     """
     Command: 0x00 0x0D
     """
-    packet = create_packet([0x00, 0x0D])
-    data = serial_command(packet)
+    if data is None:
+        packet = create_packet([0x00, 0x0D])
+        data = serial_command(packet)
+
     debug_data(data)
 
     try:
@@ -584,20 +1838,23 @@ def get_valve_status():
             )
 
             debug_msg(
-                "ByPass: {}, ByPassMotorCurrent: {}, PreHeatingMotorCurrent: {}".format(
-                    ByPass, ByPassMotorCurrent, PreHeatingMotorCurrent
-                )
+                "ByPass: {}, ByPassMotorCurrent: {}, PreHeatingMotorCurrent: {}",
+                ByPass,
+                ByPassMotorCurrent,
+                PreHeatingMotorCurrent,
             )
     except IndexError:
         warning_msg("get_valve_status ignoring incomplete message")
 
 
-def get_bypass_control():
+def get_bypass_control(data=None):
     """
     Command: 0x00 0xDF
     """
-    packet = create_packet([0x00, 0xDF])
-    data = serial_command(packet)
+    if data is None:
+        packet = create_packet([0x00, 0xDF])
+        data = serial_command(packet)
+
     debug_data(data)
 
     try:
@@ -623,47 +1880,41 @@ def get_bypass_control():
             publish_message(msg=SummerMode, mqtt_path="house/2/attic/wtw/summer_mode")
 
             debug_msg(
-                "ByPassFactor: {}, ByPassStep: {}, ByPassCorrection: {}, SummerMode: {}".format(
-                    ByPassFactor, ByPassStep, ByPassCorrection, SummerMode
-                )
+                "ByPassFactor: {}, ByPassStep: {}, ByPassCorrection: {}, SummerMode: {}",
+                ByPassFactor,
+                ByPassStep,
+                ByPassCorrection,
+                SummerMode,
             )
     except IndexError:
         warning_msg("get_bypass_control ignoring incomplete message")
 
 
-def get_preheating_status():
+def get_preheating_status(data=None):
     """
     Command: 0x00 0xE1
     """
-    status_data = {
-        "PreHeatingValveStatus": {0: "Closed", 1: "Open", "2": "Unknown"},
-        "FrostProtectionActive": {0: False, 1: True},
-        "PreHeatingActive": {0: False, 1: True},
-        "FrostProtectionLevel": {
-            0: "GuaranteedProtection",
-            1: "HighProtection",
-            2: "NominalProtection",
-            3: "Economy",
-        },
-    }
+    if data is None:
+        packet = create_packet([0x00, 0xE1])
+        data = serial_command(packet)
 
-    packet = create_packet([0x00, 0xE1])
-    data = serial_command(packet)
     debug_data(data)
 
     try:
         if data is None:
             warning_msg("get_preheating_status function could not get serial data")
         else:
-            PreHeatingValveStatus = status_data["PreHeatingValveStatus"][
+            PreHeatingValveStatus = PREHEATING_STATUS_DATA["PreHeatingValveStatus"][
                 int(data[7], 16)
             ]
-            FrostProtectionActive = status_data["FrostProtectionActive"][
+            FrostProtectionActive = PREHEATING_STATUS_DATA["FrostProtectionActive"][
                 int(data[8], 16)
             ]
-            PreHeatingActive = status_data["PreHeatingActive"][int(data[9], 16)]
+            PreHeatingActive = PREHEATING_STATUS_DATA["PreHeatingActive"][
+                int(data[9], 16)
+            ]
             FrostProtectionMinutes = int(data[10], 16) + int(data[11], 16)
-            FrostProtectionLevel = status_data["FrostProtectionLevel"][
+            FrostProtectionLevel = PREHEATING_STATUS_DATA["FrostProtectionLevel"][
                 int(data[12], 16)
             ]
 
@@ -688,13 +1939,12 @@ def get_preheating_status():
             )
 
             debug_msg(
-                "PreHeatingValveStatus: {}, FrostProtectionActive: {}, PreHeatingActive: {}, FrostProtectionMinutes: {}, FrostProtectionLevel: {}".format(
-                    PreHeatingValveStatus,
-                    FrostProtectionActive,
-                    PreHeatingActive,
-                    FrostProtectionMinutes,
-                    FrostProtectionLevel,
-                )
+                "PreHeatingValveStatus: {}, FrostProtectionActive: {}, PreHeatingActive: {}, FrostProtectionMinutes: {}, FrostProtectionLevel: {}",
+                PreHeatingValveStatus,
+                FrostProtectionActive,
+                PreHeatingActive,
+                FrostProtectionMinutes,
+                FrostProtectionLevel,
             )
     except IndexError:
         warning_msg("get_preheating_status ignoring incomplete message")
@@ -704,12 +1954,14 @@ def get_preheating_status():
         )
 
 
-def get_operating_hours():
+def get_operating_hours(data=None):
     """
     Command: 0x00 0xDD
     """
-    packet = create_packet([0x00, 0xDD])
-    data = serial_command(packet)
+    if data is None:
+        packet = create_packet([0x00, 0xDD])
+        data = serial_command(packet)
+
     debug_data(data)
 
     try:
@@ -742,61 +1994,28 @@ def get_operating_hours():
             publish_message(msg=FilterHours, mqtt_path="house/2/attic/wtw/filter_hours")
 
             debug_msg(
-                "Level0Hours: {}, Level1Hours: {}, Level2Hours: {}, Level3Hours: {}, FrostProtectionHours: {}, PreHeatingHours: {}, BypassOpenHours: {}, FilterHours: {}".format(
-                    Level0Hours,
-                    Level1Hours,
-                    Level2Hours,
-                    Level3Hours,
-                    FrostProtectionHours,
-                    PreHeatingHours,
-                    BypassOpenHours,
-                    FilterHours,
-                )
+                "Level0Hours: {}, Level1Hours: {}, Level2Hours: {}, Level3Hours: {}, FrostProtectionHours: {}, PreHeatingHours: {}, BypassOpenHours: {}, FilterHours: {}",
+                Level0Hours,
+                Level1Hours,
+                Level2Hours,
+                Level3Hours,
+                FrostProtectionHours,
+                PreHeatingHours,
+                BypassOpenHours,
+                FilterHours,
             )
     except IndexError:
         warning_msg("get_operating_hours ignoring incomplete message")
 
 
-def get_status():
+def get_status(data=None):
     """
     Command: 0x00 0xD5
     """
-    status_data = {
-        "PreHeatingPresent": {0: False, 1: True},
-        "ByPassPresent": {0: False, 1: True},
-        "Type": {2: "Right", 1: "Left"},
-        "Size": {1: "Large", 2: "Small"},
-        "OptionsPresent": {0: False, 1: True},
-        "EnthalpyPresent": {0: False, 1: True, 2: "PresentWithoutSensor"},
-        "EWTPresent": {0: False, 1: "Managed", 2: "Unmanaged"},
-    }
-
-    active1_status_data = {
-        0: "P10",
-        1: "P11",
-        2: "P12",
-        3: "P13",
-        4: "P14",
-        5: "P15",
-        6: "P16",
-        7: "P17",
-    }
+    if data is None:
+        packet = create_packet([0x00, 0xD5])
+        data = serial_command(packet)
 
-    active2_status_data = {0: "P18", 1: "P19"}
-
-    active3_status_data = {
-        0: "P90",
-        1: "P91",
-        2: "P92",
-        3: "P93",
-        4: "P94",
-        5: "P95",
-        6: "P96",
-        7: "P97",
-    }
-
-    packet = create_packet([0x00, 0xD5])
-    data = serial_command(packet)
     debug_data(data)
 
     try:
@@ -804,57 +2023,50 @@ def get_status():
             warning_msg("get_status function could not get serial data")
         else:
             try:
-                PreHeatingPresent = status_data["PreHeatingPresent"][int(data[7])]
-                ByPassPresent = status_data["ByPassPresent"][int(data[8])]
-                Type = status_data["Type"][int(data[9])]
-                Size = status_data["Size"][int(data[10])]
-                OptionsPresent = status_data["OptionsPresent"][int(data[11])]
+                PreHeatingPresent = STATUS_DATA["PreHeatingPresent"][int(data[7])]
+                ByPassPresent = STATUS_DATA["ByPassPresent"][int(data[8])]
+                Type = STATUS_DATA["Type"][int(data[9])]
+                Size = STATUS_DATA["Size"][int(data[10])]
+                OptionsPresent = STATUS_DATA["OptionsPresent"][int(data[11])]
                 ActiveStatus1 = int(data[13])  # (0x01 = P10 ... 0x80 = P17)
                 ActiveStatus2 = int(data[14])  # (0x01 = P18 / 0x02 = P19)
                 ActiveStatus3 = int(data[15])  # (0x01 = P90 ... 0x80 = P97)
-                EnthalpyPresent = status_data["EnthalpyPresent"][int(data[16])]
-                EWTPresent = status_data["EWTPresent"][int(data[17])]
+                EnthalpyPresent = STATUS_DATA["EnthalpyPresent"][int(data[16])]
+                EWTPresent = STATUS_DATA["EWTPresent"][int(data[17])]
             except ValueError as _value_err:
                 warning_msg(
                     "get_status function received an inappropriate value: {}".format(
                         _value_err
                     )
                 )
+                return
             except KeyError as _key_err:
                 warning_msg(
                     "get status function missing key in dataset: {}".format(_key_err)
                 )
+                return
 
             debug_msg(
-                "PreHeatingPresent: {}, ByPassPresent: {}, Type: {}, Size: {}, OptionsPresent: {}, EnthalpyPresent: {}, EWTPresent: {}".format(
-                    PreHeatingPresent,
-                    ByPassPresent,
-                    Type,
-                    Size,
-                    OptionsPresent,
-                    EnthalpyPresent,
-                    EWTPresent,
-                )
+                "PreHeatingPresent: {}, ByPassPresent: {}, Type: {}, Size: {}, OptionsPresent: {}, EnthalpyPresent: {}, EWTPresent: {}",
+                PreHeatingPresent,
+                ByPassPresent,
+                Type,
+                Size,
+                OptionsPresent,
+                EnthalpyPresent,
+                EWTPresent,
             )
 
-            for key, value in status_8bit(ActiveStatus1).items():
-                topic = "house/2/attic/wtw/{}_active".format(active1_status_data[key])
-                debug_msg("{}: {}".format(topic, value))
+            for topic, value in zip(ACTIVE1_TOPICS, status_8bit(ActiveStatus1)):
+                debug_msg("{}: {}", topic, value)
                 publish_message(msg=value, mqtt_path=topic)
 
-            for key, value in status_8bit(ActiveStatus2).items():
-                try:
-                    topic = "house/2/attic/wtw/{}_active".format(
-                        active2_status_data[key]
-                    )
-                    debug_msg("{}: {}".format(topic, value))
-                    publish_message(msg=value, mqtt_path=topic)
-                except KeyError:
-                    pass
-
-            for key, value in status_8bit(ActiveStatus3).items():
-                topic = "house/2/attic/wtw/{}_active".format(active3_status_data[key])
-                debug_msg("{}: {}".format(topic, value))
+            for topic, value in zip(ACTIVE2_TOPICS, status_8bit(ActiveStatus2)):
+                debug_msg("{}: {}", topic, value)
+                publish_message(msg=value, mqtt_path=topic)
+
+            for topic, value in zip(ACTIVE3_TOPICS, status_8bit(ActiveStatus3)):
+                debug_msg("{}: {}", topic, value)
                 publish_message(msg=value, mqtt_path=topic)
 
             publish_message(
@@ -876,13 +2088,15 @@ def get_status():
         warning_msg("get_status ignoring incomplete message")
 
 
-def get_delay_timers():
+def get_delay_timers(data=None):
     """
     Command: 0x00 0xC9
     """
 
-    packet = create_packet([0x00, 0xC9])
-    data = serial_command(packet)
+    if data is None:
+        packet = create_packet([0x00, 0xC9])
+        data = serial_command(packet)
+
     debug_data(data)
 
     try:
@@ -969,29 +2183,647 @@ def get_delay_timers():
             )
 
             debug_msg(
-                "BathroomSwitchOnDelayMinutes: {}, BathroomSwitchOffDelayMinutes: {}, L1SwitchOffDelayMinutes: {}, BoostVentilationMinutes: {}, FilterWarningWeeks: {}, RFHighTimeShortMinutes: {}, RFHighTimeLongMinutes: {}, ExtractorHoodSwitchOffDelayMinutes: {}".format(
-                    BathroomSwitchOnDelayMinutes,
-                    BathroomSwitchOffDelayMinutes,
-                    L1SwitchOffDelayMinutes,
-                    BoostVentilationMinutes,
-                    FilterWarningWeeks,
-                    RFHighTimeShortMinutes,
-                    RFHighTimeLongMinutes,
-                    ExtractorHoodSwitchOffDelayMinutes,
-                )
+                "BathroomSwitchOnDelayMinutes: {}, BathroomSwitchOffDelayMinutes: {}, L1SwitchOffDelayMinutes: {}, BoostVentilationMinutes: {}, FilterWarningWeeks: {}, RFHighTimeShortMinutes: {}, RFHighTimeLongMinutes: {}, ExtractorHoodSwitchOffDelayMinutes: {}",
+                BathroomSwitchOnDelayMinutes,
+                BathroomSwitchOffDelayMinutes,
+                L1SwitchOffDelayMinutes,
+                BoostVentilationMinutes,
+                FilterWarningWeeks,
+                RFHighTimeShortMinutes,
+                RFHighTimeLongMinutes,
+                ExtractorHoodSwitchOffDelayMinutes,
             )
     except IndexError:
         warning_msg("get_delay_timers ignoring incomplete message")
 
 
+"""
+Command groups of the command line interface
+"""
+COMMAND_GROUPS = {
+    "temp": get_temp,
+    "ventilation": get_ventilation_status,
+    "filter": get_filter_status,
+    "fans": get_fan_status,
+    "bypass": get_bypass_control,
+    "valve": get_valve_status,
+    "status": get_status,
+    "hours": get_operating_hours,
+    "preheating": get_preheating_status,
+    "timers": get_delay_timers,
+}
+
+
+"""
+Decoders for the frames seen on the serial line in passive mode, indexed by the command
+bytes. The get_ functions decode the replies of the unit when they are called with data
+"""
+POLL_REPLIES = {
+    get_temp: "00d2",
+    get_ventilation_status: "00ce",
+    get_filter_status: "00da",
+    get_fan_status: "000c",
+    get_bypass_control: "00e0",
+    get_valve_status: "000e",
+    get_status: "00d6",
+    get_operating_hours: "00de",
+    get_preheating_status: "00e2",
+    get_delay_timers: "00ca",
+}
+
+REPLY_DECODERS = {command: func for func, command in POLL_REPLIES.items()}
+
+
+def decode_ventilation_level_request(data):
+    """
+    Command: 0x00 0x99, sent by the control panel
+    """
+    FanLevel = int(data[7], 16) - 1
+    publish_message(msg=FanLevel, mqtt_path="house/2/attic/wtw/ventilation_level")
+    debug_msg("Control panel set FanLevel: {}", FanLevel)
+
+
+def decode_comfort_temperature_request(data):
+    """
+    Command: 0x00 0xD3, sent by the control panel
+    """
+    ComfortTemp = int(data[7], 16) / 2.0 - 20
+    publish_message(msg=ComfortTemp, mqtt_path="house/2/attic/wtw/comfort_temp")
+    debug_msg("Control panel set ComfortTemp: {}", ComfortTemp)
+
+
+REQUEST_DECODERS = {
+    "0099": decode_ventilation_level_request,
+    "00d3": decode_comfort_temperature_request,
+}
+
+"""validate_data expects the ACK in front of a frame"""
+ACK_RAW = [b"\x07", b"\xf3"]
+
+
+def decode_frame(frame):
+    """
+    Decode a frame seen on the serial line, either a request from the control panel or a
+    reply from the unit
+    """
+    data = validate_data(ACK_RAW + [frame[i : i + 1] for i in range(len(frame))])
+    if data is None:
+        return
+
+    command = data[4] + data[5]
+    decoder = REPLY_DECODERS.get(command, REQUEST_DECODERS.get(command))
+
+    if decoder is None:
+        debug_msg("No decoder for command {}", command)
+        return
+
+    last_seen[command] = time.monotonic()
+    serial_stats["frames"] += 1
+
+    try:
+        decoder(data)
+    except IndexError:
+        warning_msg("Ignoring incomplete frame for command {}".format(command))
+
+
+def sniff(seconds):
+    """
+    Listen to the serial line for seconds and decode the traffic between the control panel
+    and the unit. Rules and commands are handled as soon as they arrive.
+    """
+    deadline = time.monotonic() + seconds
+
+    while time.monotonic() < deadline:
+        waiting = ser.inWaiting()
+        if waiting > 0:
+            for frame in sniffer.feed(ser.read(waiting)):
+                decode_frame(frame)
+        elif wakeup.wait(0.05):
+            wakeup.clear()
+            apply_rules()
+            handle_commands()
+
+        handle_refresh()
+
+
+def stale_functions(functions, gap):
+    """
+    Return the functions whose reply was not seen on the serial line for gap seconds
+    """
+    now = time.monotonic()
+
+    return [
+        func
+        for func in functions
+        if now - last_seen.get(POLL_REPLIES[func], -math.inf) > gap
+    ]
+
+
+def open_serial(port):
+    return serial.Serial(
+        port=port,
+        baudrate=9600,
+        bytesize=serial.EIGHTBITS,
+        parity=serial.PARITY_NONE,
+        stopbits=serial.STOPBITS_ONE,
+    )
+
+
+class DecodeCollector:
+    """
+    Sink for the readings of decode_capture, which keeps the byte offset of the frame with
+    every reading
+    """
+
+    def __init__(self):
+        self.offset = 0
+        self.columns = {}
+
+    def add(self, reading):
+        column = self.columns.get(reading.name)
+        if column is None:
+            column = self.columns[reading.name] = ([], [])
+
+        column[0].append(self.offset)
+        column[1].append(reading.value)
+
+
+"""Bytes per value in the npy output of fields that are not numeric"""
+DECODE_TEXT_WIDTH = 24
+
+
+def capture_chunks(path, chunk_size):
+    """
+    Read a capture file in chunks of about chunk_size bytes, split at the start of a frame,
+    and yield (offset, chunk). Only one chunk is kept in memory, also on a long stretch
+    without a frame start.
+    """
+    offset = 0
+    rest = b""
+
+    with open(path, "rb") as f:
+        while True:
+            block = f.read(chunk_size)
+            if not block:
+                break
+
+            data = rest + block
+            split = frame_start(data)
+            if split <= 0:
+                if len(data) <= chunk_size + FrameSniffer.max_frame_length:
+                    """No frame start besides the first byte yet, continue reading"""
+                    rest = data
+                    continue
+
+                """
+                A frame is never longer than max_frame_length, so only a 0x07 at the end
+                can still start one
+                """
+                split = len(data) - 1
+
+            yield offset, data[:split]
+            offset += split
+            rest = data[split:]
+
+    if rest:
+        yield offset, rest
+
+
+def frame_start(data):
+    """
+    Position of the last 0x07 0xF0 in data that starts a frame, like FrameSniffer: the 0x07
+    must not be the second byte of an escaped 0x07 0x07
+    """
+    position = data.rfind(b"\x07\xf0")
+
+    while position > 0:
+        escaped = 0
+        while position - escaped - 1 >= 0 and data[position - escaped - 1] == 0x07:
+            escaped += 1
+
+        if escaped % 2 == 0:
+            return position
+
+        position = data.rfind(b"\x07\xf0", 0, position)
+
+    return position
+
+
+def decode_chunk(offset, chunk, output_format):
+    """
+    Decode the frames of a chunk of a capture file in a worker process. Returns the number
+    of frames, the number of decoded frames and per field the kind ("f8" or "S") with the
+    encoded offsets and values, ready to be appended to the output files.
+    """
+    global debug
+    global warning
+    global sinks
+
+    debug = False
+    warning = False
+    collector = DecodeCollector()
+    sinks = [collector]
+
+    frames = FrameSniffer().feed(chunk)
+    decoded = serial_stats["frames"]
+    failed = 0
+    position = 0
+    for frame in frames:
+        position = chunk.find(frame, position)
+        collector.offset = offset + position
+        position += len(frame)
+
+        try:
+            decode_frame(frame)
+        except (ArithmeticError, LookupError, ValueError):
+            """A corrupt frame in a capture should not stop the whole batch"""
+            failed += 1
+
+    decoded = serial_stats["frames"] - decoded - failed
+
+    columns = {}
+    for name, (offsets, values) in collector.columns.items():
+        numeric = all(isinstance(value, (int, float)) for value in values)
+
+        if output_format == "csv":
+            columns[name] = (
+                "f8" if numeric else "S",
+                "".join(
+                    "{},{}\n".format(o, value) for o, value in zip(offsets, values)
+                ),
+            )
+        elif numeric:
+            columns[name] = (
+                "f8",
+                array.array("q", offsets).tobytes(),
+                array.array("d", values).tobytes(),
+            )
+        else:
+            columns[name] = (
+                "S",
+                array.array("q", offsets).tobytes(),
+                b"".join(
+                    str(value)
+                    .encode()[:DECODE_TEXT_WIDTH]
+                    .ljust(DECODE_TEXT_WIDTH, b"\0")
+                    for value in values
+                ),
+            )
+
+    return len(frames), decoded, columns
+
+
+class ColumnWriter:
+    """
+    Write decoded fields to one file per field in directory: name.csv with offset,value
+    lines, or name.npy with the values and name.offset.npy with the byte offsets. The npy
+    data is appended to temporary files and the header is added on close, when the length
+    is known.
+    """
+
+    def __init__(self, directory, output_format):
+        self.directory = directory
+        self.output_format = output_format
+        self.files = {}
+        self.kinds = {}
+        self.counts = collections.Counter()
+        self.skipped = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, name, suffix):
+        return os.path.join(self.directory, name + suffix)
+
+    def open(self, name, suffix, mode):
+        key = (name, suffix)
+        if key not in self.files:
+            self.files[key] = open(self.path(name, suffix), mode)
+
+        return self.files[key]
+
+    def write(self, name, column):
+        kind = column[0]
+        if self.kinds.setdefault(name, kind) != kind:
+            """The output type of a field is fixed by its first values"""
+            self.skipped += 1
+            return
+
+        if self.output_format == "csv":
+            f = self.open(name, ".csv", "w")
+            if self.counts[name] == 0:
+                f.write("offset,value\n")
+            f.write(column[1])
+            self.counts[name] += column[1].count("\n")
+            return
+
+        self.open(name, ".offset.npy.tmp", "wb").write(column[1])
+        self.open(name, ".npy.tmp", "wb").write(column[2])
+        self.counts[name] += len(column[1]) // 8
+
+    def close(self):
+        import shutil
+
+        for f in self.files.values():
+            f.close()
+
+        if self.output_format == "csv":
+            return
+
+        for name, kind in self.kinds.items():
+            text = "|S{}".format(DECODE_TEXT_WIDTH)
+            for suffix, descr in (
+                (".offset.npy", "<i8"),
+                (".npy", "<f8" if kind == "f8" else text),
+            ):
+                with open(self.path(name, suffix), "wb") as f:
+                    header = {
+                        "descr": descr,
+                        "fortran_order": False,
+                        "shape": (self.counts[name],),
+                    }
+                    write_npy_header(f, header)
+                    with open(self.path(name, suffix + ".tmp"), "rb") as tmp:
+                        shutil.copyfileobj(tmp, f)
+
+                os.remove(self.path(name, suffix + ".tmp"))
+
+
+def write_npy_header(f, header):
+    """
+    Write a version 1.0 npy header, so the output can be written without numpy
+    """
+    text = repr(header).encode("latin1")
+    padding = 64 - (10 + len(text) + 1) % 64
+    text += b" " * padding + b"\n"
+    f.write(b"\x93NUMPY\x01\x00" + len(text).to_bytes(2, "little") + text)
+
+
+def capture_prefixes(paths):
+    """
+    Prefix of the output fields per capture file: none for a single file, the file name
+    without suffix, or when file names repeat the path relative to the common directory,
+    so siteA/capture.bin and siteB/capture.bin become "siteA.capture." and "siteB.capture."
+    """
+    if len(paths) == 1:
+        return [""]
+
+    stems = [Path(path).stem for path in paths]
+    if len(set(stems)) == len(stems):
+        return [stem + "." for stem in stems]
+
+    absolute = [os.path.abspath(path) for path in paths]
+    common = os.path.commonpath([os.path.dirname(path) for path in absolute])
+
+    return [
+        str(Path(os.path.relpath(path, common)).with_suffix("")).replace(os.sep, ".")
+        + "."
+        for path in absolute
+    ]
+
+
+def decode_captures(paths, directory, output_format, jobs, chunk_size):
+    """
+    Decode raw serial capture files with a pool of worker processes. The files are read in
+    chunks split at frame boundaries, at most two chunks per worker are in flight, and the
+    results are written in file order. With more than one file the fields are prefixed
+    with the name of the file, see capture_prefixes.
+    """
+    import concurrent.futures
+
+    prefixes = capture_prefixes(paths)
+    if len(set(prefixes)) < len(prefixes):
+        warning_msg(
+            "The output of the captures would overwrite each other: {}".format(
+                ", ".join(paths)
+            )
+        )
+        return 1
+
+    totals = [0, 0]
+    start = time.monotonic()
+
+    def collect(future, writer, prefix):
+        frames, decoded, columns = future.result()
+        totals[0] += frames
+        totals[1] += decoded
+        for name, column in columns.items():
+            writer.write(prefix + name, column)
+
+    with concurrent.futures.ProcessPoolExecutor(jobs) as pool:
+        for path, prefix in zip(paths, prefixes):
+            writer = ColumnWriter(directory, output_format)
+            in_flight = collections.deque()
+
+            for offset, chunk in capture_chunks(path, chunk_size):
+                in_flight.append(
+                    pool.submit(decode_chunk, offset, chunk, output_format)
+                )
+                if len(in_flight) >= jobs * 2:
+                    collect(in_flight.popleft(), writer, prefix)
+
+            while in_flight:
+                collect(in_flight.popleft(), writer, prefix)
+
+            writer.close()
+            if writer.skipped > 0:
+                warning_msg(
+                    "Skipped {} chunks of {} with values of another type".format(
+                        writer.skipped, path
+                    )
+                )
+
+    info_msg(
+        "Decoded {} of {} frames in {:.1f} seconds".format(
+            totals[1], totals[0], time.monotonic() - start
+        )
+    )
+
+    return 0 if totals[1] > 0 else 1
+
+
+def cli(argv):
+    """
+    One-shot command line interface to query and set the WHR930 directly on the serial
+    port, without MQTT and without loading config.yaml. Examples:
+
+        whr930.py get temp fans --json
+        whr930.py set level 2
+        whr930.py set comfort_temperature 21
+        whr930.py decode capture.bin --output decoded --format npy
+    """
+    global debug
+    global warning
+    global ser
+
+    parser = argparse.ArgumentParser(prog="whr930")
+    parser.add_argument("--port", default="/dev/ttyUSB0", help="serial port")
+    parser.add_argument("--debug", action="store_true", help="show debug messages")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    get_parser = commands.add_parser("get", help="query the unit")
+    get_parser.add_argument(
+        "groups", nargs="+", choices=list(COMMAND_GROUPS) + ["all"], metavar="group"
+    )
+    get_parser.add_argument("--json", action="store_true", help="output as json")
+
+    set_parser = commands.add_parser("set", help="change a setting of the unit")
+    set_parser.add_argument(
+        "setting",
+        choices=["level", "comfort_temperature", "default_fan_speed_levels"],
+    )
+    set_parser.add_argument("value", nargs="?", type=float)
+
+    decode_parser = commands.add_parser(
+        "decode", help="decode raw serial capture files"
+    )
+    decode_parser.add_argument("captures", nargs="+", help="capture files")
+    decode_parser.add_argument(
+        "--output", default="decoded", help="directory for the files per field"
+    )
+    decode_parser.add_argument("--format", choices=["csv", "npy"], default="csv")
+    decode_parser.add_argument(
+        "--jobs", type=int, default=os.cpu_count(), help="worker processes"
+    )
+    decode_parser.add_argument(
+        "--chunk-size", type=int, default=1048576, help="bytes per chunk"
+    )
+
+    args = parser.parse_args(argv)
+
+    debug = args.debug
+    warning = True
+
+    if args.command == "decode":
+        return decode_captures(
+            args.captures, args.output, args.format, args.jobs, args.chunk_size
+        )
+
+    ser = open_serial(args.port)
+
+    try:
+        if args.command == "set":
+            if args.setting == "default_fan_speed_levels":
+                result = set_default_fan_speed_levels()
+            elif args.value is None:
+                parser.error("set {} needs a value".format(args.setting))
+            elif args.setting == "level":
+                result = set_ventilation_level(int(args.value))
+            else:
+                result = set_comfort_temperature(args.value)
+
+            return 0 if result else 1
+
+        if "all" in args.groups:
+            groups = list(COMMAND_GROUPS)
+        else:
+            groups = args.groups
+
+        for group in groups:
+            COMMAND_GROUPS[group]()
+    finally:
+        ser.close()
+
+    if not readings:
+        return 1
+
+    values = {reading.name: reading.value for reading in readings.values()}
+
+    if args.json:
+        print(json.dumps(values))
+    else:
+        for name, value in values.items():
+            print("{}: {}".format(name, value))
+
+    return 0
+
+
 def on_message(client, userdata, message):
     debug_msg(
-        "message received: topic: {0}, payload: {1}, userdata: {2}".format(
-            message.topic, message.payload, userdata
-        )
+        "message received: topic: {0}, payload: {1}, userdata: {2}",
+        message.topic,
+        message.payload,
+        userdata,
     )
 
+    for rule in rules:
+        if message.topic == rule["topic"]:
+            update_rule(rule, message.payload)
+            wakeup.set()
+            return
+
+    if message.topic == "house/2/attic/wtw/refresh":
+        request_refresh(message.payload)
+        wakeup.set()
+        return
+
     pending_commands.append(message)
+    wakeup.set()
+
+
+def request_refresh(payload):
+    """
+    Schedule a refresh of the command groups in the payload, a comma separated list or json
+    array of group names or "all". Requests arriving within refresh_window seconds of the
+    first one are combined, so every command is polled only once.
+    """
+    global refresh_due
+
+    try:
+        groups = json.loads(payload)
+        if not isinstance(groups, list):
+            groups = [groups]
+    except ValueError:
+        groups = payload.decode(errors="replace").split(",")
+
+    for group in groups:
+        group = str(group).strip()
+
+        if group == "all":
+            refresh_requests.update(COMMAND_GROUPS.values())
+        elif group in COMMAND_GROUPS:
+            refresh_requests.add(COMMAND_GROUPS[group])
+        else:
+            warning_msg("Ignoring refresh of unknown command group {}".format(group))
+
+    if refresh_due is None:
+        refresh_due = time.monotonic() + refresh_window
+
+
+def handle_refresh():
+    """
+    Poll the requested command groups ahead of the regular rotation. A command is skipped
+    when its data is younger than refresh_min_interval seconds.
+    """
+    global refresh_due
+
+    if refresh_due is None or time.monotonic() < refresh_due:
+        return
+
+    refresh_due = None
+
+    while refresh_requests:
+        func = refresh_requests.pop()
+        command = POLL_REPLIES[func]
+
+        if time.monotonic() - last_seen.get(command, -math.inf) < refresh_min_interval:
+            debug_msg("Skipping refresh of {}, data is recent", func)
+            continue
+
+        debug_msg("Refreshing {}", func)
+        poll(func)
+
+
+def poll(func):
+    """
+    Call a get_ function to poll the unit, the trace of the frame ends with the function
+    """
+    global current_trace
+
+    func()
+
+    trace = current_trace
+    current_trace = None
+    if trace is not None and trace.decoded > 0 and brokers:
+        brokers[0].publish(None, None, trace)
 
 
 def handle_commands():
@@ -1002,14 +2834,14 @@ def handle_commands():
         if message.topic == "house/2/attic/wtw/set_ventilation_level":
             fan_level = int(float(message.payload))
             set_ventilation_level(fan_level)
-            get_ventilation_status()
+            poll(get_ventilation_status)
         elif message.topic == "house/2/attic/wtw/set_comfort_temperature":
             temperature = float(message.payload)
             set_comfort_temperature(temperature)
-            get_temp()
+            poll(get_temp)
         elif message.topic == "house/2/attic/wtw/set_default_fan_speed_levels":
             set_default_fan_speed_levels()
-            get_fan_status()
+            poll(get_fan_status)
         else:
             info_msg(
                 "Received a message on topic {} where we do not have a handler for at the moment".format(
@@ -1018,27 +2850,148 @@ def handle_commands():
             )
 
 
-def recon():
+def load_rules(config):
+    """
+    Local control rules: when the value on topic reaches on_above, the ventilation is set to
+    level. The rule is released when the value drops to off_below, but not before it was
+    active for min_hold seconds. When multiple rules are active, the highest level wins.
+    """
+    loaded = []
+
+    for rule in config:
+        loaded.append(
+            {
+                "topic": rule["topic"],
+                "value_key": rule.get("value_key"),
+                "on_above": float(rule["on_above"]),
+                "off_below": float(rule.get("off_below", rule["on_above"])),
+                "level": int(rule.get("level", 3)),
+                "min_hold": float(rule.get("min_hold", 0)),
+                "value": None,
+                "active": False,
+                "since": 0.0,
+            }
+        )
+
+    return loaded
+
+
+def update_rule(rule, payload):
+    """
+    Store the new sensor value of a rule, the payload is a number or a json object
+    containing the number under value_key
+    """
     try:
-        mqttc.reconnect()
-        info_msg("Successfull reconnected to the MQTT server")
-        topic_subscribe()
-    except:
+        if rule["value_key"] is None:
+            rule["value"] = float(payload)
+        else:
+            rule["value"] = float(json.loads(payload)[rule["value_key"]])
+    except (ValueError, KeyError, TypeError) as _err:
         warning_msg(
-            "Could not reconnect to the MQTT server. Trying again in 10 seconds"
+            "Ignoring value {} on topic {}: {}".format(payload, rule["topic"], _err)
         )
-        time.sleep(10)
-        recon()
 
 
-def topic_subscribe():
+def apply_rules():
+    """
+    Evaluate the local control rules and set the ventilation level directly when the level
+    wanted by the rules changed. When no rule is active anymore, the level from before the
+    first rule became active is restored. A level that could not be set is tried again
+    after rules_retry_min seconds, doubling up to rules_retry_max seconds while it keeps
+    failing, so a unit that refuses the command does not starve the polling.
+    """
+    global rules_level
+    global rules_release_level
+    global rules_failures
+    global rules_retry_at
+
+    if not rules:
+        return
+
+    now = time.monotonic()
+    wanted = None
+
+    for rule in rules:
+        value = rule["value"]
+
+        if value is not None:
+            if rule["active"] is False and value >= rule["on_above"]:
+                rule["active"] = True
+                rule["since"] = now
+                info_msg(
+                    "Rule on {} activated by value {}".format(rule["topic"], value)
+                )
+            elif (
+                rule["active"] is True
+                and value <= rule["off_below"]
+                and now - rule["since"] >= rule["min_hold"]
+            ):
+                rule["active"] = False
+                info_msg("Rule on {} released by value {}".format(rule["topic"], value))
+
+        if rule["active"] is True and (wanted is None or rule["level"] > wanted):
+            wanted = rule["level"]
+
+    if wanted == rules_level or now < rules_retry_at:
+        return
+
+    if wanted is None:
+        result = set_ventilation_level(rules_release_level)
+    else:
+        if rules_level is None:
+            reading = readings.get("house/2/attic/wtw/ventilation_level")
+            """The unit reports -1 for level 0 (auto), which can not be set"""
+            if reading is not None and reading.value in (0, 1, 2, 3):
+                rules_release_level = reading.value
+        result = set_ventilation_level(wanted)
+
+    if result is True:
+        rules_level = wanted
+        rules_failures = 0
+    else:
+        rules_failures += 1
+        delay = min(rules_retry_min * 2 ** (rules_failures - 1), rules_retry_max)
+        rules_retry_at = time.monotonic() + delay
+        warning_msg(
+            "Could not set the ventilation level of the rules, retrying in {} seconds".format(
+                delay
+            )
+        )
+    poll(get_ventilation_status)
+
+
+def idle(seconds):
+    """
+    Wait between two poll cycles, but apply rules and handle commands as soon as they arrive
+    """
+    deadline = time.monotonic() + seconds
+
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+
+        if refresh_due is not None:
+            remaining = max(0, min(remaining, refresh_due - time.monotonic()))
+
+        if wakeup.wait(remaining):
+            wakeup.clear()
+            apply_rules()
+            handle_commands()
+
+        handle_refresh()
+
+
+def topic_subscribe(client):
     try:
-        mqttc.subscribe(
+        client.subscribe(
             [
-                ("house/2/attic/wtw/set_ventilation_level", 0),
-                ("house/2/attic/wtw/set_comfort_temperature", 0),
-                ("house/2/attic/wtw/set_default_fan_speed_levels", 0)
+                ("house/2/attic/wtw/set_ventilation_level", 1),
+                ("house/2/attic/wtw/set_comfort_temperature", 1),
+                ("house/2/attic/wtw/set_default_fan_speed_levels", 1),
+                ("house/2/attic/wtw/refresh", 1),
             ]
+            + [(rule["topic"], 0) for rule in rules]
         )
         info_msg("Successfull subscribed to the MQTT topics")
     except:
@@ -1046,60 +2999,408 @@ def topic_subscribe():
             "There was an error while subscribing to the MQTT topic(s), trying again in 10 seconds"
         )
         time.sleep(10)
-        topic_subscribe()
+        topic_subscribe(client)
+
+
+def sd_notify(state):
+    """
+    Send a state to systemd using the sd_notify protocol. Nothing is sent when the bridge is
+    not started by systemd with Type=notify.
+    """
+    address = os.environ.get("NOTIFY_SOCKET")
+    if not address:
+        return
 
+    if address[0] == "@":
+        address = "\0" + address[1:]
 
-def on_connect(client, userdata, flags, rc):
-    topic_subscribe()
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.connect(address)
+            sock.sendall(state.encode())
+    except OSError as _err:
+        warning_msg("Could not notify systemd: {}".format(_err))
 
 
-def on_disconnect(client, userdata, rc):
-    if rc != 0:
-        warning_msg("Unexpected disconnection from MQTT, trying to reconnect")
-        recon()
+def notify_ready():
+    """
+    Tell systemd we are ready, after the first valid serial frame and the MQTT connection
+    """
+    global systemd_ready
 
+    if (
+        systemd_ready is False
+        and brokers[0].connected is True
+        and serial_stats["frames"] > 0
+    ):
+        systemd_ready = True
+        sd_notify("READY=1")
+        info_msg("Ready, first serial frame received and connected to MQTT")
 
-def main():
+
+def notify_cycle(cycle_time, frames, errors, budget):
+    """
+    Report the health of the last poll cycle to systemd. The watchdog is only kicked when the
+    cycle finished within the budget and at least one valid frame was received, so a hanging
+    bridge or a dead serial adapter gets restarted by systemd.
+    """
+    total = frames + errors
+    error_rate = errors / total if total > 0 else 0.0
+
+    sd_notify(
+        "STATUS=Last cycle {:.1f}s, {} frames, error rate {:.0%}".format(
+            cycle_time, frames, error_rate
+        )
+    )
+
+    if cycle_time <= budget and frames > 0:
+        sd_notify("WATCHDOG=1")
+    else:
+        warning_msg(
+            "Unhealthy cycle: {:.1f}s (budget {}s), {} frames, {} errors".format(
+                cycle_time, budget, frames, errors
+            )
+        )
+
+
+def start_profiling():
+    """
+    Enable cProfile and tracemalloc, used to find out where the time and memory go in the main loop
+    """
+    global profiler
+
+    import cProfile
+    import tracemalloc
+
+    tracemalloc.start(25)
+    profiler = cProfile.Profile()
+    profiler.enable()
+    info_msg("Profiling enabled")
+
+
+def profile_thread(thread_profiler):
+    """
+    cProfile only records the thread that enabled it, so the broker threads call this for every
+    message: it enables a profiler of their own while profiling is on, and disables it and hands
+    it over to stop_profiling once profiling stops. Returns the profiler for the next call. The
+    paho network threads are not covered, the socket writes of a publish are not in the results.
+    """
+    if profiler is not None and thread_profiler is None:
+        import cProfile
+
+        thread_profiler = cProfile.Profile()
+        thread_profilers[threading.get_ident()] = (thread_profiler, threading.Event())
+        thread_profiler.enable()
+    elif profiler is None and thread_profiler is not None:
+        thread_profiler.disable()
+        entry = thread_profilers.get(threading.get_ident())
+        if entry is not None:
+            entry[1].set()
+        thread_profiler = None
+
+    return thread_profiler
+
+
+def folded_stacks(stats):
+    """
+    Convert pstats data into collapsed stacks ("root;caller;callee microseconds"), the input format
+    of flamegraph.pl, inferno and speedscope. cProfile only records caller/callee pairs, so the time
+    of a function is divided over its callers in proportion to the cumulative time of each call.
+    """
+
+    def name(func):
+        filename, lineno, funcname = func
+        if filename == "~":
+            return funcname
+        return "{}:{}:{}".format(funcname, os.path.basename(filename), lineno)
+
+    callees = {}
+    for func, (cc, nc, tt, ct, callers) in stats.items():
+        for caller in callers:
+            callees.setdefault(caller, []).append(func)
+
+    stacks = {}
+
+    def walk(func, path, fraction):
+        cc, nc, tt, ct, callers = stats[func]
+        path = path + [name(func)]
+        own = int(tt * fraction * 1000000)
+        if own > 0:
+            key = ";".join(path)
+            stacks[key] = stacks.get(key, 0) + own
+
+        for callee in callees.get(func, []):
+            if name(callee) in path:
+                continue
+            callee_ct = stats[callee][3]
+            edge_ct = stats[callee][4][func][3]
+            if callee_ct > 0:
+                walk(callee, path, fraction * edge_ct / callee_ct)
+
+    for func, (cc, nc, tt, ct, callers) in stats.items():
+        if not callers:
+            walk(func, [], 1.0)
+
+    return stacks
+
+
+def stop_profiling(output):
+    """
+    Stop profiling and write the results:
+
+        <output>              : raw pstats data (snakeviz, flameprof, gprof2dot)
+        <output>.folded       : cpu time per call stack in collapsed format (flamegraph.pl)
+        <output>.alloc.folded : allocated bytes per call stack in collapsed format (flamegraph.pl)
+        <output>.txt          : cumulative time per function and the top allocation sites
+    """
+    global profiler
+
+    import tracemalloc
+
+    main_profiler = profiler
+    main_profiler.disable()
+    snapshot = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    """A thread profiler can only be disabled by its own thread, wake them to hand it over"""
+    profiler = None
+    for broker in brokers:
+        broker.event.set()
+
+    """Imported after profiling stopped, so the import is not part of the results"""
+    import pstats
+
+    stats = pstats.Stats(main_profiler)
+    for thread_profiler, done in list(thread_profilers.values()):
+        if done.wait(5):
+            stats.add(thread_profiler)
+        else:
+            warning_msg(
+                "A broker thread did not stop profiling, left out of the results"
+            )
+    thread_profilers.clear()
+    stats.dump_stats(output)
+
+    with open("{}.folded".format(output), "w") as f:
+        for stack, value in sorted(folded_stacks(stats.stats).items()):
+            f.write("{} {}\n".format(stack, value))
+
+    with open("{}.alloc.folded".format(output), "w") as f:
+        for stat in snapshot.statistics("traceback"):
+            stack = ";".join(
+                "{}:{}".format(os.path.basename(frame.filename), frame.lineno)
+                for frame in stat.traceback
+            )
+            f.write("{} {}\n".format(stack, stat.size))
+
+    with open("{}.txt".format(output), "w") as f:
+        stats.stream = f
+        stats.sort_stats("cumulative").print_stats(40)
+
+        f.write("Top allocation sites\n\n")
+        for stat in snapshot.statistics("lineno")[:25]:
+            f.write("{}\n".format(stat))
+
+    info_msg("Profiling finished, results written to {}".format(output))
+
+
+def setup(config):
+    """
+    Apply the configuration, connect to the MQTT servers and open the serial port
+    """
     global debug
     global debug_level
     global warning
-    global mqttc
+    global brokers
     global ser
     global pending_commands
-
-    with Path(__file__).with_name("config.yaml").open("r") as f:
-        config = yaml.safe_load(f.read())
+    global profiler
+    global offline_buffer_config
+    global offline_flush_rate
+    global mqtt_policy
+    global mqtt_default_policy
+    global rules
+    global sniffer
+    global sinks
+    global retry_default
+    global retry_policy
+    global retry_reset_after
+    global refresh_window
+    global refresh_min_interval
+    global http_stale_after
+    global tracing
+    global trace_frames
+    global trace_summary_every
+    global passive
+    global passive_listen
+    global passive_gap
+    global cycle_budget
+    global state_segment
+    global filters
 
     debug = config["debug"]
     debug_level = 0
     warning = config["warning"]
 
     pending_commands = []
+    rules = load_rules(config.get("rules", []))
+    filters = load_filters(config.get("filters", {}))
+    sinks = [create_sink(sink) for sink in config.get("sinks", [])]
+
+    retry_default = (
+        config.get("retry_attempts", 3),
+        config.get("retry_delay", 0.2),
+        config.get("retry_jitter", 0.3),
+    )
+    retry_reset_after = config.get("retry_reset_after", 5)
+    retry_policy = {}
+    for group, policy in config.get("retry_commands", {}).items():
+        reply = POLL_REPLIES[COMMAND_GROUPS[group]]
+        retry_policy["{:04x}".format(int(reply, 16) - 1)] = (
+            policy.get("attempts", retry_default[0]),
+            policy.get("delay", retry_default[1]),
+            policy.get("jitter", retry_default[2]),
+        )
+
+    offline_buffer_config = {
+        "max_topics": config.get("offline_buffer_max_topics", 500),
+        "max_events": config.get("offline_buffer_max_events", 100),
+        "max_age": config.get("offline_buffer_max_age", 3600),
+        "event_topics": config.get("offline_event_topics", []),
+    }
+    offline_flush_rate = config.get("offline_flush_rate", 20)
+
+    tracing = config.get("trace", False)
+    trace_frames = config.get("trace_frames", False)
+    trace_summary_every = config.get("trace_summary_every", 100)
 
-    """Connect to the MQTT broker"""
-    mqttc = mqtt.Client("whr930")
-    mqttc.username_pw_set(
-        username=config["mqtt_username"], password=config["mqtt_password"]
+    refresh_window = config.get("refresh_window", 0.5)
+    refresh_min_interval = config.get("refresh_min_interval", 2)
+
+    cycle_budget = config.get("cycle_budget", 120)
+    passive = config.get("passive", False)
+    passive_listen = config.get("passive_listen", 5)
+    passive_gap = config.get("passive_gap", 60)
+    sniffer = FrameSniffer()
+
+    profiler = None
+
+    mqtt_default_policy = (
+        config.get("mqtt_qos", 0),
+        config.get("mqtt_retain", True),
+        config.get("mqtt_message_expiry", 0),
     )
+    mqtt_policy = {}
+    for name, policy in config.get("mqtt_topic_policy", {}).items():
+        mqtt_policy["house/2/attic/wtw/{}".format(name)] = (
+            policy.get("qos", mqtt_default_policy[0]),
+            policy.get("retain", mqtt_default_policy[1]),
+            policy.get("expiry", mqtt_default_policy[2]),
+        )
 
-    """Define the mqtt callbacks"""
-    mqttc.on_connect = on_connect
-    mqttc.on_message = on_message
-    mqttc.on_disconnect = on_disconnect
+    """The primary MQTT server, followed by the servers we only publish to"""
+    brokers = [
+        Broker(
+            {
+                "server": config["mqtt_server"],
+                "port": config.get("mqtt_port"),
+                "username": config["mqtt_username"],
+                "password": config["mqtt_password"],
+                "tls": config.get("mqtt_tls"),
+                "protocol": config.get("mqtt_protocol", 3),
+                "session_expiry": config.get("mqtt_session_expiry", 0),
+            },
+            primary=True,
+        )
+    ]
+    for n, broker in enumerate(config.get("mqtt_brokers", []), start=1):
+        brokers.append(Broker(broker, client_id="whr930-{}".format(n)))
 
-    """Connect to the MQTT server"""
-    mqttc.connect(config["mqtt_server"], port=1883, keepalive=45)
+    """Connect to the MQTT servers"""
+    for broker in brokers:
+        broker.start()
 
     """Open the serial port"""
-    ser = serial.Serial(
-        port=config["port"],
-        baudrate=9600,
-        bytesize=serial.EIGHTBITS,
-        parity=serial.PARITY_NONE,
-        stopbits=serial.STOPBITS_ONE,
+    ser = open_serial(config["port"])
+
+    if config.get("shm_path"):
+        """The reader module holds the layout, it is only needed with shared memory"""
+        import whr930_shm
+
+        state_segment = whr930_shm.StateWriter(
+            config["shm_path"], config.get("shm_slots", 128)
+        )
+
+    http_stale_after = config.get("http_stale_after", 120)
+    if config.get("http_port", 0) > 0:
+        start_http_server(config.get("http_address", "127.0.0.1"), config["http_port"])
+
+
+def run_cycle(functions):
+    """
+    Poll the functions once, or listen to the serial line first in passive mode, then wait
+    for the next cycle
+    """
+    cycle_start = time.monotonic()
+    frames = serial_stats["frames"]
+    errors = serial_stats["errors"]
+
+    if passive is True:
+        sniff(passive_listen)
+        cycle_functions = stale_functions(functions, passive_gap)
+    else:
+        cycle_functions = functions
+
+    for func in cycle_functions:
+        apply_rules()
+        handle_refresh()
+
+        if len(pending_commands) == 0:
+            debug_msg("Executing function {}", func)
+            poll(func)
+        else:
+            handle_commands()
+
+        notify_ready()
+
+    publish_serial_stats()
+
+    if passive is False:
+        idle(5)
+
+    notify_ready()
+    notify_cycle(
+        time.monotonic() - cycle_start,
+        serial_stats["frames"] - frames,
+        serial_stats["errors"] - errors,
+        cycle_budget,
     )
 
-    mqttc.loop_start()
+
+def shutdown():
+    sd_notify("STOPPING=1")
+    for sink in sinks:
+        sink.close()
+    for broker in brokers:
+        broker.stop()
+    if state_segment is not None:
+        state_segment.close()
+    ser.close()
+
+
+def main():
+    if len(sys.argv) > 1:
+        return cli(sys.argv[1:])
+
+    import yaml
+
+    with Path(__file__).with_name("config.yaml").open("r") as f:
+        config = yaml.safe_load(f.read())
+
+    setup(config)
+
+    profile_cycles = config.get("profile_cycles", 0)
+    profile_output = config.get("profile_output", "/tmp/whr930.prof")
 
     functions = [
         get_temp,
@@ -1114,20 +3415,20 @@ def main():
         get_delay_timers,
     ]
 
+    if profile_cycles > 0:
+        start_profiling()
+
+    cycle = 0
+
     while True:
         try:
-            for func in functions:
-                if len(pending_commands) == 0:
-                    debug_msg("Executing function {}".format(func))
-                    func()
-                else:
-                    handle_commands()
-
-            time.sleep(5)
-            pass
+            run_cycle(functions)
+            cycle += 1
+
+            if profiler is not None and cycle >= profile_cycles:
+                stop_profiling(profile_output)
         except KeyboardInterrupt:
-            mqttc.loop_stop()
-            ser.close()
+            shutdown()
             break
 
 
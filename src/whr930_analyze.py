@@ -0,0 +1,549 @@
+#!/usr/bin/env python3
+"""
+Offline analysis of the readings recorded by the csv or sqlite sink of whr930.py.
+
+Fan RPM per speed percent drifts when the filters clog, because the fans run against a
+growing pressure drop. The readings since the last filter change are compared per speed
+percent with the first baseline_days after the change, the daily drift is fitted with a
+rolling linear regression and extrapolated to the drift at which the filters should be
+replaced. The heat recovery efficiency is reported alongside.
+
+    whr930_analyze.py /var/lib/whr930/readings.csv /var/lib/whr930/readings.csv.1
+    whr930_analyze.py /var/lib/whr930/readings.db --json
+
+Parsed readings are cached per file in cache_dir, so rotated files are parsed once and of
+the live file only the lines appended since the last run.
+
+Requires numpy 1.23 or newer, which is not needed for whr930.py itself.
+"""
+
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    sys.exit("whr930_analyze.py requires numpy, install it with 'pip install numpy'")
+
+DAY = 86400.0
+
+FIELDS = (
+    "intake_fan_speed",
+    "exhaust_fan_speed",
+    "intake_fan_speed_rpm",
+    "exhaust_fan_speed_rpm",
+    "outside_air_temp",
+    "supply_air_temp",
+    "return_air_temp",
+    "valve_bypass_percentage",
+    "filter_hours",
+)
+
+"""Lines per chunk, keeps the memory use bounded for files of any size"""
+CHUNK_LINES = 1000000
+
+"""
+Names and values are parsed as bytes, which is a lot faster than str. Longer names are
+truncated, but can not match one of FIELDS.
+"""
+ROW = [("timestamp", "f8"), ("name", "S24"), ("value", "S24")]
+
+CACHE_VERSION = 1
+
+
+def field_key(name):
+    """
+    Length and the first, middle (only used above 16 bytes) and last 8 bytes of a name as
+    integers, which identify a name of 8 to 24 bytes exactly
+    """
+    words = np.frombuffer(name.ljust(16, b"\0")[:16], dtype="<u8")
+    last = np.frombuffer(name[-8:], dtype="<u8")[0]
+    return len(name), words[0], words[1] if len(name) > 16 else None, last
+
+
+FIELD_KEYS = [field_key(name.encode()) for name in FIELDS]
+
+
+def select_lines(block):
+    """
+    The complete lines of block with one of FIELDS as name, found with vectorized numpy
+    operations on the raw bytes, so the lines of the other topics are never parsed
+    """
+    data = np.frombuffer(block, dtype="u1")
+    ends = np.flatnonzero(data == 10) + 1
+    commas = np.flatnonzero(data == 44)
+    if len(ends) == 0 or len(commas) < 2:
+        return []
+
+    """The name is between the first and the second comma of a line"""
+    starts = np.concatenate(([0], ends[:-1]))
+    first = np.minimum(np.searchsorted(commas, starts), len(commas) - 2)
+    name_start = commas[first] + 1
+    name_end = commas[first + 1]
+    length = name_end - name_start
+
+    """8 byte integers at every position of the block"""
+    padded = block + b"\0" * 8
+    words = np.ndarray((len(block) + 1,), dtype="<u8", buffer=padded, strides=(1,))
+    head = words[name_start]
+    tail = words[np.maximum(name_end - 8, 0)]
+    middle = None
+
+    keep = np.zeros(len(starts), dtype=bool)
+    for size, first_word, middle_word, last_word in FIELD_KEYS:
+        match = (length == size) & (head == first_word) & (tail == last_word)
+        if middle_word is not None:
+            if middle is None:
+                middle = words[np.minimum(name_start + 8, len(block))]
+            match &= middle == middle_word
+        keep |= match
+
+    keep &= (name_start > starts) & (name_end < ends)
+
+    return [
+        block[start:end]
+        for start, end in zip(starts[keep].tolist(), ends[keep].tolist())
+    ]
+
+
+def load_csv(path, cache_dir):
+    """
+    Parse the lines of FIELDS of a csv file (timestamp, name, value) in chunks with the
+    numpy parser, values with a comma (like the JSON of house/2/attic/wtw/outlier) are
+    quoted by the sink. Returns
+    {name: [(timestamps, values)]} for FIELDS. The result is cached by inode, which stays
+    the same when the csv sink rotates the file, with the parsed length and the first line
+    of the file to notice a replaced file.
+    """
+    stat = os.stat(path)
+    series = {}
+    cache = None
+    if cache_dir is not None:
+        cache = os.path.join(cache_dir, "{}-{}.npz".format(stat.st_dev, stat.st_ino))
+
+    with open(path, "rb") as f:
+        head = f.readline()
+        offset = 0
+
+        if cache is not None and os.path.exists(cache):
+            with np.load(cache) as cached:
+                if (
+                    cached["version"] == CACHE_VERSION
+                    and cached["head"].tobytes() == head
+                    and cached["offset"] <= stat.st_size
+                ):
+                    offset = int(cached["offset"])
+                    for name in FIELDS:
+                        if name + ".t" in cached:
+                            series[name] = [(cached[name + ".t"], cached[name + ".v"])]
+
+        f.seek(offset)
+        cached_offset = offset
+        while True:
+            block = f.read(CHUNK_LINES * 40)
+
+            """Without a newline the sink is still writing the last line"""
+            end = block.rfind(b"\n") + 1
+            if end == 0:
+                break
+
+            offset += end
+            f.seek(offset)
+
+            lines = select_lines(block[:end])
+            if lines:
+                chunk = np.loadtxt(
+                    lines, delimiter=",", quotechar='"', dtype=ROW, ndmin=1
+                )
+                add_chunk(chunk["timestamp"], chunk["name"], chunk["value"], series)
+
+    if cache is None or offset == cached_offset:
+        return series
+
+    arrays = {}
+    for name, chunks in series.items():
+        arrays[name + ".t"] = np.concatenate([c[0] for c in chunks])
+        arrays[name + ".v"] = np.concatenate([c[1] for c in chunks])
+        series[name] = [(arrays[name + ".t"], arrays[name + ".v"])]
+
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(cache + ".tmp", "wb") as f:
+        np.savez(
+            f,
+            version=CACHE_VERSION,
+            head=np.frombuffer(head, dtype="u1"),
+            offset=offset,
+            **arrays
+        )
+    os.replace(cache + ".tmp", cache)
+
+    return series
+
+
+def load_sqlite(path):
+    """
+    Read the readings table of a sqlite sink database in chunks, returns
+    {name: [(timestamps, values)]} for FIELDS
+    """
+    series = {}
+    db = sqlite3.connect("file:{}?mode=ro".format(path), uri=True)
+    cursor = db.execute(
+        "SELECT timestamp, name, CAST(value AS TEXT) FROM readings WHERE name IN ({})".format(
+            ",".join("?" * len(FIELDS))
+        ),
+        FIELDS,
+    )
+
+    while True:
+        rows = cursor.fetchmany(CHUNK_LINES)
+        if not rows:
+            break
+
+        chunk = np.array(rows, dtype=ROW)
+        add_chunk(chunk["timestamp"], chunk["name"], chunk["value"], series)
+
+    db.close()
+
+    return series
+
+
+def add_chunk(timestamps, names, values, series):
+    for name in FIELDS:
+        mask = names == name.encode()
+        if not mask.any():
+            continue
+
+        try:
+            numbers = values[mask].astype("f8")
+        except ValueError:
+            """Skip values that are not numeric, like an error text"""
+            numbers = np.array(
+                [float(v) if is_number(v) else np.nan for v in values[mask]],
+                dtype="f8",
+            )
+
+        series.setdefault(name, []).append((timestamps[mask], numbers))
+
+
+def is_number(value):
+    try:
+        float(value)
+        return True
+    except ValueError:
+        return False
+
+
+def load(paths, cache_dir=None):
+    """
+    Load readings from csv files and sqlite databases, returns {name: (timestamps, values)}
+    sorted by timestamp, rotated csv files can be given in any order
+    """
+    series = {}
+    for path in paths:
+        if path.endswith((".db", ".sqlite", ".sqlite3")):
+            loaded = load_sqlite(path)
+        else:
+            loaded = load_csv(path, cache_dir)
+
+        for name, chunks in loaded.items():
+            series.setdefault(name, []).extend(chunks)
+
+    result = {}
+    for name, chunks in series.items():
+        timestamps = np.concatenate([c[0] for c in chunks])
+        values = np.concatenate([c[1] for c in chunks])
+        valid = ~np.isnan(values)
+        timestamps = timestamps[valid]
+        values = values[valid]
+        order = np.argsort(timestamps, kind="stable")
+        result[name] = (timestamps[order], values[order])
+
+    return result
+
+
+def as_of(series, timestamps):
+    """
+    The last value of series at each of timestamps (forward fill), NaN before the first
+    value
+    """
+    known_timestamps, known_values = series
+    index = np.searchsorted(known_timestamps, timestamps, side="right") - 1
+    result = known_values[np.maximum(index, 0)].astype("f8")
+    result[index < 0] = np.nan
+    return result
+
+
+def last_filter_change(data):
+    """
+    The timestamp of the last reset of the filter hours counter, None when no reset was
+    recorded. whr930.py publishes the sum of the two counter bytes, which also drops when
+    the low byte wraps (0x01ff is 256, 0x0200 is 2), but only a reset drops it to 0.
+    """
+    if "filter_hours" not in data:
+        return None
+
+    timestamps, hours = data["filter_hours"]
+    resets = np.nonzero((np.diff(hours) < 0) & (hours[1:] == 0))[0]
+    if len(resets) == 0:
+        return None
+
+    return timestamps[resets[-1] + 1]
+
+
+def fan_drift(data, fan, since, baseline_days):
+    """
+    Relative deviation of the RPM per sample from the median RPM at the same speed percent
+    during the baseline, returns (timestamps, drift)
+    """
+    timestamps, rpm = data["{}_fan_speed_rpm".format(fan)]
+    percent = as_of(data["{}_fan_speed".format(fan)], timestamps)
+
+    keep = (timestamps >= since) & (percent > 0) & ~np.isnan(percent)
+    timestamps = timestamps[keep]
+    rpm = rpm[keep]
+    percent = percent[keep].astype("i8")
+
+    baseline = timestamps < since + baseline_days * DAY
+    if not baseline.any():
+        return timestamps[:0], rpm[:0]
+
+    """Median RPM per speed percent during the baseline"""
+    levels, level_index = np.unique(percent, return_inverse=True)
+    reference = np.full(len(levels), np.nan)
+    for i in np.unique(level_index[baseline]):
+        reference[i] = np.median(rpm[baseline & (level_index == i)])
+
+    expected = reference[level_index]
+    known = ~np.isnan(expected)
+
+    return timestamps[known], rpm[known] / expected[known] - 1
+
+
+def efficiency(data, since, min_delta):
+    """
+    Heat recovery efficiency (supply - outside) / (return - outside) per sample, only when
+    the bypass is closed and the indoor/outdoor difference is at least min_delta degrees
+    """
+    timestamps, supply = data["supply_air_temp"]
+    outside = as_of(data["outside_air_temp"], timestamps)
+    indoor = as_of(data["return_air_temp"], timestamps)
+    delta = indoor - outside
+
+    keep = (timestamps >= since) & (np.abs(delta) >= min_delta)
+    if "valve_bypass_percentage" in data:
+        keep &= as_of(data["valve_bypass_percentage"], timestamps) == 0
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        result = (supply[keep] - outside[keep]) / delta[keep]
+
+    return timestamps[keep], result
+
+
+def daily(timestamps, values, since):
+    """
+    Mean per day since since, returns (days, means) for the days with samples
+    """
+    day = ((timestamps - since) // DAY).astype("i8")
+    if len(day) == 0:
+        return np.zeros(0), np.zeros(0)
+
+    counts = np.bincount(day)
+    sums = np.bincount(day, weights=values)
+    present = counts > 0
+    days = np.nonzero(present)[0].astype("f8")
+
+    return days, sums[present] / counts[present]
+
+
+def rolling_regression(x, y, window):
+    """
+    Least squares fit of y = intercept + slope * x over the last window points ending at
+    each point, with cumulative sums so every fit is O(1). Returns (slope, intercept)
+    arrays, NaN for the first window - 1 points.
+    """
+    slope = np.full(len(x), np.nan)
+    intercept = np.full(len(x), np.nan)
+    if len(x) < window or window < 2:
+        return slope, intercept
+
+    def windowed(values):
+        sums = np.concatenate(([0.0], np.cumsum(values)))
+        return sums[window:] - sums[:-window]
+
+    sx = windowed(x)
+    sy = windowed(y)
+    sxx = windowed(x * x)
+    sxy = windowed(x * y)
+
+    denominator = window * sxx - sx * sx
+    with np.errstate(invalid="ignore", divide="ignore"):
+        slope[window - 1 :] = (window * sxy - sx * sy) / denominator
+    intercept[window - 1 :] = (sy - slope[window - 1 :] * sx) / window
+
+    return slope, intercept
+
+
+def trend(days, values, window):
+    """
+    The fitted value and slope per day at the last day, NaN when there are not enough
+    days
+    """
+    slope, intercept = rolling_regression(days, values, window)
+    if len(days) == 0 or np.isnan(slope[-1]):
+        return np.nan, np.nan
+
+    return intercept[-1] + slope[-1] * days[-1], slope[-1]
+
+
+def analyze(data, since, baseline_days, window, replace_drift, min_delta):
+    report = {
+        "since": time.strftime("%Y-%m-%d", time.localtime(since)),
+        "fans": {},
+    }
+
+    scores = []
+    projections = []
+    for fan in ("intake", "exhaust"):
+        if "{}_fan_speed_rpm".format(fan) not in data:
+            continue
+
+        timestamps, drift = fan_drift(data, fan, since, baseline_days)
+        days, drift_per_day = daily(timestamps, drift, since)
+        current, slope = trend(days, drift_per_day, window)
+        if np.isnan(current):
+            continue
+
+        """The drift can go both ways, depending on the fan curve"""
+        direction = 1 if current >= 0 else -1
+        score = min(max(direction * current / replace_drift, 0.0), 1.0)
+
+        days_left = None
+        if direction * slope > 0:
+            days_left = max((direction * replace_drift - current) / slope, 0.0)
+            projections.append(since + (days[-1] + days_left) * DAY)
+
+        scores.append(score)
+        report["fans"][fan] = {
+            "drift_percent": round(current * 100, 2),
+            "drift_percent_per_week": round(slope * 700, 3),
+            "clogging_score": round(score, 3),
+            "days_left": None if days_left is None else round(days_left, 1),
+        }
+
+    if all(name in data for name in FIELDS[4:7]):
+        timestamps, values = efficiency(data, since, min_delta)
+        days, per_day = daily(timestamps, values, since)
+        current, slope = trend(days, per_day, window)
+        if not np.isnan(current):
+            report["efficiency"] = {
+                "percent": round(current * 100, 1),
+                "percent_per_week": round(slope * 700, 3),
+            }
+
+    report["clogging_score"] = round(max(scores), 3) if scores else None
+    report["replace_filters"] = (
+        time.strftime("%Y-%m-%d", time.localtime(min(projections)))
+        if projections
+        else None
+    )
+
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="whr930_analyze",
+        description="Estimate filter clogging from recorded whr930 readings",
+    )
+    parser.add_argument("paths", nargs="+", help="csv files or sqlite databases")
+    parser.add_argument(
+        "--since",
+        help="date of the last filter change (YYYY-MM-DD), by default the last reset "
+        "of filter_hours to 0 or the first reading",
+    )
+    parser.add_argument(
+        "--baseline-days", type=float, default=7, help="days to use as clean reference"
+    )
+    parser.add_argument(
+        "--window", type=int, default=14, help="days per rolling regression"
+    )
+    parser.add_argument(
+        "--replace-drift",
+        type=float,
+        default=10,
+        help="RPM drift in percent at which the filters should be replaced",
+    )
+    parser.add_argument(
+        "--min-delta",
+        type=float,
+        default=5,
+        help="minimum indoor/outdoor difference in degrees for the efficiency",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=os.path.expanduser("~/.cache/whr930"),
+        help="directory for parsed csv files",
+    )
+    parser.add_argument(
+        "--no-cache", action="store_true", help="parse the csv files without cache"
+    )
+    parser.add_argument("--json", action="store_true", help="output as json")
+    args = parser.parse_args(argv)
+
+    start = time.monotonic()
+    data = load(args.paths, None if args.no_cache else args.cache_dir)
+
+    if not any("{}_fan_speed_rpm".format(fan) in data for fan in ("intake", "exhaust")):
+        sys.exit("No fan readings found in {}".format(", ".join(args.paths)))
+
+    if args.since is not None:
+        since = time.mktime(time.strptime(args.since, "%Y-%m-%d"))
+    else:
+        since = last_filter_change(data)
+        if since is None:
+            since = min(timestamps[0] for timestamps, values in data.values())
+
+    report = analyze(
+        data,
+        since,
+        args.baseline_days,
+        args.window,
+        args.replace_drift / 100.0,
+        args.min_delta,
+    )
+    report["samples"] = int(
+        sum(len(timestamps) for timestamps, values in data.values())
+    )
+    report["seconds"] = round(time.monotonic() - start, 2)
+
+    if args.json:
+        print(json.dumps(report))
+        return
+
+    print("Readings since {}: {}".format(report["since"], report["samples"]))
+    for fan, result in report["fans"].items():
+        print(
+            "{} fan: RPM drift {}% ({}% per week), clogging score {}".format(
+                fan.capitalize(),
+                result["drift_percent"],
+                result["drift_percent_per_week"],
+                result["clogging_score"],
+            )
+        )
+    if "efficiency" in report:
+        print(
+            "Heat recovery efficiency: {}% ({}% per week)".format(
+                report["efficiency"]["percent"],
+                report["efficiency"]["percent_per_week"],
+            )
+        )
+    print("Clogging score: {}".format(report["clogging_score"]))
+    print("Projected filter replacement: {}".format(report["replace_filters"] or "-"))
+
+
+if __name__ == "__main__":
+    main()
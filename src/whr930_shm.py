@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+"""
+Shared memory state of the whr930 bridge. With shm_path set in config.yaml the bridge keeps
+the last value of every reading in a memory mapped file with a fixed layout, so local
+processes can read the state without MQTT or HTTP:
+
+    import whr930_shm
+
+    reader = whr930_shm.StateReader("/dev/shm/whr930.state")
+    state = reader.read()  # {"comfort_temp": (20.0, 1700000000.0), ...}
+
+Layout, little endian:
+
+    header  magic (8s) "WHR930S2", sequence (Q), slots (I), slot size (I), used slots (I)
+    slots   name (48s), type (B), value (d), text (24s), timestamp (d)
+
+The sequence is a seqlock: the bridge makes it odd before it changes a slot and even again
+afterwards. A reader copies the slots and retries when the sequence was odd or changed in
+the meantime, so every value it returns was written completely.
+"""
+
+import json
+import mmap
+import os
+import struct
+import sys
+import time
+
+MAGIC = b"WHR930S2"
+HEADER = struct.Struct("<8sQIII")
+SEQUENCE = struct.Struct("<Q")
+SEQUENCE_OFFSET = 8
+USED = struct.Struct("<I")
+USED_OFFSET = 24
+NAME_SIZE = 48
+SLOT = struct.Struct("<{}sBxxxxxxxd24sd".format(NAME_SIZE))
+SLOTS_OFFSET = 64
+
+EMPTY = 0
+INT = 1
+FLOAT = 2
+BOOL = 3
+TEXT = 4
+NONE = 5
+
+
+def encode(value):
+    """
+    Type, number and text of a value for a slot
+    """
+    if value is None:
+        return NONE, 0.0, b""
+    if isinstance(value, bool):
+        return BOOL, float(value), b""
+    if isinstance(value, int):
+        return INT, float(value), b""
+    if isinstance(value, float):
+        return FLOAT, value, b""
+
+    return TEXT, 0.0, str(value).encode()[:24]
+
+
+def decode(kind, number, text):
+    if kind == INT:
+        return int(number)
+    if kind == FLOAT:
+        return number
+    if kind == BOOL:
+        return number != 0
+    if kind == TEXT:
+        return text.rstrip(b"\0").decode(errors="replace")
+
+    return None
+
+
+class StateWriter:
+    """
+    Writer side, used by the bridge. Every name gets the next free slot the first time it
+    is written. Names longer than NAME_SIZE bytes and names beyond the number of slots are
+    not stored but counted in dropped, update returns False the first time such a name is
+    seen so the caller can warn about it.
+    """
+
+    def __init__(self, path, slots=128):
+        self.slots = slots
+        self.index = {}
+        self.rejected = set()
+        self.sequence = 0
+        self.dropped = 0
+
+        size = SLOTS_OFFSET + slots * SLOT.size
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            """Never shrink the file, a reader that still has it mapped would get SIGBUS"""
+            size = max(size, os.fstat(fd).st_size)
+            os.ftruncate(fd, size)
+            self.map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+        self.map[:size] = bytes(size)
+        HEADER.pack_into(self.map, 0, MAGIC, 0, slots, SLOT.size, 0)
+
+    def update(self, name, value, timestamp):
+        slot = self.index.get(name)
+        if slot is None:
+            if len(self.index) >= self.slots or len(name.encode()) > NAME_SIZE:
+                self.dropped += 1
+                if name in self.rejected:
+                    return True
+
+                self.rejected.add(name)
+                return False
+
+            slot = self.index[name] = len(self.index)
+
+        kind, number, text = encode(value)
+
+        self.sequence += 1
+        SEQUENCE.pack_into(self.map, SEQUENCE_OFFSET, self.sequence)
+
+        SLOT.pack_into(
+            self.map,
+            SLOTS_OFFSET + slot * SLOT.size,
+            name.encode(),
+            kind,
+            number,
+            text,
+            timestamp,
+        )
+        USED.pack_into(self.map, USED_OFFSET, len(self.index))
+
+        self.sequence += 1
+        SEQUENCE.pack_into(self.map, SEQUENCE_OFFSET, self.sequence)
+        return True
+
+    def close(self):
+        self.map.close()
+
+
+class StateReader:
+    """
+    Reader side, keeps the file mapped so every read only copies the used slots
+    """
+
+    def __init__(self, path="/dev/shm/whr930.state"):
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, sequence, slots, slot_size, used = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or slot_size != SLOT.size:
+            raise ValueError("{} is not a whr930 state file".format(path))
+
+        """The bridge may have been restarted with more slots than fit in our mapping"""
+        self.capacity = (len(self.map) - SLOTS_OFFSET) // SLOT.size
+
+    def snapshot(self, retries=1000):
+        """
+        A consistent copy of the used slots as (sequence, used, bytes)
+        """
+        for attempt in range(retries):
+            magic, sequence, slots, slot_size, used = HEADER.unpack_from(self.map, 0)
+            if sequence % 2 == 0:
+                used = min(used, self.capacity)
+                data = self.map[SLOTS_OFFSET : SLOTS_OFFSET + used * SLOT.size]
+
+                if SEQUENCE.unpack_from(self.map, SEQUENCE_OFFSET)[0] == sequence:
+                    return sequence, used, data
+
+            """Let the bridge finish the update"""
+            time.sleep(0)
+
+        raise TimeoutError("The state is changing too fast to read")
+
+    def read(self):
+        """
+        {name: (value, timestamp)} of all readings
+        """
+        sequence, used, data = self.snapshot()
+        state = {}
+
+        for name, kind, number, text, timestamp in SLOT.iter_unpack(data):
+            if kind != EMPTY:
+                state[name.rstrip(b"\0").decode()] = (
+                    decode(kind, number, text),
+                    timestamp,
+                )
+
+        return state
+
+    def close(self):
+        self.map.close()
+
+
+def read_state(path="/dev/shm/whr930.state"):
+    reader = StateReader(path)
+    try:
+        return reader.read()
+    finally:
+        reader.close()
+
+
+if __name__ == "__main__":
+    print(json.dumps(read_state(*sys.argv[1:2]), indent=2))
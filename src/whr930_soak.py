@@ -0,0 +1,690 @@
+#!/usr/bin/env python3
+"""
+Soak test of the complete whr930.py pipeline: the configuration from config.yaml is used
+with a simulated WHR930 on the serial port and a minimal MQTT server on localhost. The
+clock of the bridge is virtual, every sleep and wait of the main loop returns at once and
+moves the clock forward, so weeks of poll cycles run in an hour.
+
+During the run the resident memory, open file descriptors, threads, cycle latency and the
+length of the internal queues are sampled. The run fails when any of them grew beyond its
+threshold between the start (after warm_up) and the end of the run.
+
+Before the run the allocations of whr930.py in the steady-state poll loop are checked with
+tracemalloc: after a warm-up, the memory still held by objects allocated in whr930.py must
+not grow over alloc_cycles cycles by more than max_alloc_growth. The sinks are checked too:
+the InfluxDB sink against a local stand-in HTTP server that first rejects a batch and then
+fails with a server error, the csv and sqlite sinks in a temporary directory.
+
+    whr930_soak.py --days 14
+    whr930_soak.py --days 2 --debug --error-rate 0.05 --samples soak.csv
+
+The bridge itself writes to /dev/null unless --verbose is given, the report goes to stderr.
+"""
+
+import argparse
+import contextlib
+import csv
+import http.server
+import os
+import random
+import socket
+import sqlite3
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from pathlib import Path
+
+import yaml
+
+import whr930
+
+"""
+Reply data of the simulated unit per reply command, the first byte is data[7] of the
+decoders. The bytes listed in VARIED change a little with every reply.
+"""
+REPLY_DATA = {
+    0x00D2: [0x50, 0x3C, 0x4E, 0x52, 0x40, 0x0F, 0x00, 0x00, 0x00],
+    0x00CE: [15, 35, 50, 15, 35, 50, 33, 33, 2, 1, 70, 70, 0, 0],
+    0x000C: [50, 50, 0x03, 0xE8, 0x03, 0xF0],
+    0x00DA: [0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00]
+    + [0x00, 0x00, 0x00, 0x00, 0x00, 0x00],
+    0x00E0: [0x00, 0x00, 0x80, 0x01, 0x00, 0x00, 0x00],
+    0x000E: [0x00, 0x00, 0x00, 0x00],
+    0x00D6: [0x00, 0x01, 0x01, 0x01, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00]
+    + [0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00],
+    0x00DE: [0x01] * 22,
+    0x00E2: [0x00, 0x00, 0x00, 0x00, 0x00, 0x00],
+    0x00CA: [0x01] * 8,
+}
+
+VARIED = {0x00D2: (1, 2, 3, 4), 0x000C: (0, 1, 3, 5)}
+
+
+class SimulatedSerial:
+    """
+    Answers every command like a WHR930: an ACK followed by the reply for get commands, a
+    plain ACK for set commands. With error_rate a reply is sometimes corrupted, to exercise
+    the retries and port resets.
+    """
+
+    def __init__(self, error_rate=0.0, seed=0):
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.buffer = b""
+        self.is_open = True
+
+    def write(self, packet):
+        command = packet[2] * 256 + packet[3]
+        reply = command + 1
+
+        if reply not in REPLY_DATA:
+            self.buffer = b"\x07\xf3"
+            return len(packet)
+
+        data = list(REPLY_DATA[reply])
+        for index in VARIED.get(reply, ()):
+            data[index] += self.random.randint(-2, 2)
+
+        self.buffer = b"\x07\xf3" + bytes(whr930.create_packet([0x00, reply], data))
+
+        if self.random.random() < self.error_rate:
+            self.buffer = self.buffer[: self.random.randrange(len(self.buffer))]
+
+        return len(packet)
+
+    def inWaiting(self):
+        return len(self.buffer)
+
+    def read(self, size=1):
+        data = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        return data
+
+    def reset_input_buffer(self):
+        self.buffer = b""
+
+    def open(self):
+        self.is_open = True
+
+    def close(self):
+        self.is_open = False
+
+
+class VirtualClock:
+    """
+    Replaces the time module of the bridge. A sleep of the main thread returns at once and
+    moves the clock forward, other threads (the MQTT publishers) really sleep, divided by
+    speed, or just yield when speed is 0.
+    """
+
+    def __init__(self, speed=0):
+        self.speed = speed
+        self.offset = 0.0
+        self.main = threading.main_thread()
+
+    def advance(self, seconds):
+        self.offset += max(seconds, 0)
+
+    def monotonic(self):
+        return time.monotonic() + self.offset
+
+    def time(self):
+        return time.time() + self.offset
+
+    def sleep(self, seconds):
+        if threading.current_thread() is self.main:
+            self.advance(seconds)
+
+        time.sleep(seconds / self.speed if self.speed > 0 else 0)
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+class VirtualEvent(threading.Event):
+    """
+    wakeup of the bridge, a wait of the main thread that is not woken up right away moves
+    the virtual clock forward by the timeout
+    """
+
+    def __init__(self, clock):
+        super().__init__()
+        self.clock = clock
+
+    def wait(self, timeout=None):
+        if timeout is None or threading.current_thread() is not self.clock.main:
+            return super().wait(timeout)
+
+        if super().wait(0):
+            return True
+
+        self.clock.advance(timeout)
+        return False
+
+
+class MQTTServer:
+    """
+    Minimal MQTT 3.1.1 server for the soak test: accepts connections, subscriptions
+    (exact topics and # wildcards) and publishes with QoS 0, 1 and 2, and forwards
+    messages to the subscribers with QoS 0.
+    """
+
+    def __init__(self):
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen()
+        self.port = self.sock.getsockname()[1]
+        self.subscriptions = {}
+        self.lock = threading.Lock()
+        self.received = 0
+        threading.Thread(target=self.accept, daemon=True).start()
+
+    def accept(self):
+        while True:
+            conn, address = self.sock.accept()
+            threading.Thread(target=self.serve, args=(conn,), daemon=True).start()
+
+    def read_packet(self, conn):
+        header = conn.recv(1)
+        if not header:
+            return None, None
+
+        length = 0
+        shift = 0
+        while True:
+            byte = conn.recv(1)[0]
+            length += (byte & 0x7F) << shift
+            shift += 7
+            if byte & 0x80 == 0:
+                break
+
+        body = b""
+        while len(body) < length:
+            chunk = conn.recv(length - len(body))
+            if not chunk:
+                return None, None
+            body += chunk
+
+        return header[0], body
+
+    def serve(self, conn):
+        try:
+            while True:
+                header, body = self.read_packet(conn)
+                if header is None:
+                    break
+
+                kind = header >> 4
+                if kind == 1:
+                    conn.sendall(b"\x20\x02\x00\x00")
+                elif kind == 3:
+                    self.received += 1
+                    qos = (header >> 1) & 0x03
+                    if qos > 0:
+                        topic_length = int.from_bytes(body[:2], "big")
+                        packet_id = body[2 + topic_length : 4 + topic_length]
+                        conn.sendall(
+                            (b"\x40\x02" if qos == 1 else b"\x50\x02") + packet_id
+                        )
+                elif kind == 6:
+                    conn.sendall(b"\x70\x02" + body[:2])
+                elif kind == 8:
+                    self.subscribe(conn, body)
+                elif kind == 12:
+                    conn.sendall(b"\xd0\x00")
+                elif kind == 14:
+                    break
+        except OSError:
+            pass
+        finally:
+            with self.lock:
+                for subscribers in self.subscriptions.values():
+                    subscribers.discard(conn)
+            conn.close()
+
+    def subscribe(self, conn, body):
+        packet_id = body[:2]
+        position = 2
+        granted = b""
+
+        with self.lock:
+            while position < len(body):
+                length = int.from_bytes(body[position : position + 2], "big")
+                topic = body[position + 2 : position + 2 + length].decode()
+                position += 3 + length
+                self.subscriptions.setdefault(topic, set()).add(conn)
+                granted += b"\x00"
+
+        conn.sendall(bytes([0x90, 2 + len(granted)]) + packet_id + granted)
+
+    def publish(self, topic, payload):
+        topic = topic.encode()
+        body = len(topic).to_bytes(2, "big") + topic + payload
+        length = len(body)
+        remaining = b""
+        while True:
+            byte = length & 0x7F
+            length >>= 7
+            remaining += bytes([byte | (0x80 if length else 0)])
+            if not length:
+                break
+
+        with self.lock:
+            subscribers = set()
+            for pattern, conns in self.subscriptions.items():
+                if pattern == topic.decode() or (
+                    pattern.endswith("#") and topic.decode().startswith(pattern[:-1])
+                ):
+                    subscribers |= conns
+
+        for conn in subscribers:
+            try:
+                conn.sendall(b"\x30" + remaining + body)
+            except OSError:
+                pass
+
+
+class InfluxDBServer:
+    """
+    Stand-in for the InfluxDB write endpoint: answers the first writes with the status
+    codes in statuses and the others with 204, and keeps the lines of the accepted writes
+    """
+
+    def __init__(self, statuses=()):
+        self.statuses = list(statuses)
+        self.lines = []
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers["Content-Length"]))
+                status = server.statuses.pop(0) if server.statuses else 204
+                if status == 204:
+                    server.lines.extend(body.decode().splitlines())
+
+                self.send_response(status)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        self.http = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.port = self.http.server_address[1]
+        threading.Thread(target=self.http.serve_forever, daemon=True).start()
+
+
+def check_sinks():
+    """
+    Write three batches of 10 readings to every sink. The stand-in server rejects the first
+    batch (400), which must be dropped, and fails on the second (503), which must be sent
+    again with the third. Returns the failures.
+    """
+    server = InfluxDBServer([400, 503])
+    failures = []
+
+    with tempfile.TemporaryDirectory() as directory:
+        sinks = [
+            whr930.InfluxDBSink(
+                "http://127.0.0.1:{}/write?db=whr930".format(server.port),
+                batch_size=1000,
+                flush_interval=3600,
+            ),
+            whr930.CSVSink(os.path.join(directory, "readings.csv")),
+            whr930.SQLiteSink(os.path.join(directory, "readings.db")),
+        ]
+
+        reading = whr930.Reading("house/2/attic/wtw/comfort_temp")
+        for batch in range(3):
+            for n in range(10):
+                reading.value = 20.0 + n / 2
+                reading.timestamp = time.time()
+                for sink in sinks:
+                    sink.add(reading)
+
+            for sink in sinks:
+                sink.flush()
+
+        for sink in sinks:
+            sink.close()
+
+        with open(os.path.join(directory, "readings.csv")) as f:
+            csv_rows = sum(1 for line in f)
+
+        db = sqlite3.connect(os.path.join(directory, "readings.db"))
+        sqlite_rows = db.execute("SELECT COUNT(*) FROM readings").fetchone()[0]
+        db.close()
+
+    written = (
+        ("influxdb sink wrote", len(server.lines), 20),
+        ("influxdb sink dropped", sinks[0].dropped, 10),
+        ("csv sink wrote", csv_rows, 30),
+        ("sqlite sink wrote", sqlite_rows, 30),
+    )
+    for name, count, expected in written:
+        if count != expected:
+            failures.append(
+                "{} {} readings instead of {}".format(name, count, expected)
+            )
+
+    server.http.shutdown()
+    return failures
+
+
+def sample():
+    """
+    Resident memory in KiB, open file descriptors and threads of this process
+    """
+    rss = 0
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                rss = int(line.split()[1])
+
+    return rss, len(os.listdir("/proc/self/fd")), threading.active_count()
+
+
+def backlog():
+    """
+    Messages waiting anywhere in the bridge: commands, the queues and offline buffers of
+    the MQTT servers and the in-flight messages of paho
+    """
+    total = len(whr930.pending_commands) + len(whr930.trace_pending)
+    for broker in whr930.brokers:
+        total += len(broker.queue) + len(broker.offline_buffer)
+        total += len(getattr(broker.client, "_out_messages", ()))
+
+    return total
+
+
+def drain(timeout):
+    """
+    Wait until the MQTT publishers emptied their queues. The main loop produces faster
+    than the publishers send at maximum speed, without this every queue would only
+    measure its own maximum length.
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if all(len(broker.queue) == 0 for broker in whr930.brokers):
+            return
+
+        time.sleep(0.001)
+
+
+def allocations(functions, cycles):
+    """
+    Run cycles poll cycles to warm up and twice cycles with tracemalloc, returns the growth
+    of the memory held by objects allocated in whr930.py over the last cycles, and the
+    peak of the traced memory (all threads) per cycle above the memory held before it
+    """
+    for cycle in range(cycles):
+        whr930.run_cycle(functions)
+        drain(1)
+
+    only_bridge = [tracemalloc.Filter(True, whr930.__file__)]
+    peak = 0
+
+    tracemalloc.start()
+    try:
+        """The objects replaced every cycle are traced once the first cycles ran"""
+        for cycle in range(cycles * 2):
+            if cycle == cycles:
+                before = tracemalloc.take_snapshot().filter_traces(only_bridge)
+
+            tracemalloc.reset_peak()
+            current = tracemalloc.get_traced_memory()[0]
+            whr930.run_cycle(functions)
+            peak = max(peak, tracemalloc.get_traced_memory()[1] - current)
+            drain(1)
+
+        after = tracemalloc.take_snapshot().filter_traces(only_bridge)
+    finally:
+        tracemalloc.stop()
+
+    growth = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+    return growth, peak
+
+
+def median(samples, key):
+    return statistics.median(sample[key] for sample in samples)
+
+
+def check(samples, args):
+    """
+    Compare the start of the run (after warm_up) with the end, returns the failures
+    """
+    window = max(1, int(len(samples) * 0.1))
+    start = samples[
+        int(len(samples) * args.warm_up) : int(len(samples) * args.warm_up) + window
+    ]
+    end = samples[-window:]
+
+    limits = (
+        ("rss", args.max_rss_growth * 1024, " KiB"),
+        ("fds", args.max_fd_growth, ""),
+        ("threads", args.max_thread_growth, ""),
+        ("backlog", args.max_backlog_growth, " messages"),
+    )
+
+    failures = []
+    for key, limit, unit in limits:
+        growth = median(end, key) - median(start, key)
+        if growth > limit:
+            failures.append(
+                "{} grew by {}{} (limit {}{})".format(key, growth, unit, limit, unit)
+            )
+
+    """Cycles take a few milliseconds, below min_latency_growth the ratio is only jitter"""
+    growth = median(end, "latency") - median(start, "latency")
+    ratio = median(end, "latency") / max(median(start, "latency"), 1e-9)
+    if ratio > args.max_latency_growth and growth > args.min_latency_growth / 1000:
+        failures.append(
+            "cycle latency grew by a factor {:.2f}, {:.1f} ms (limit {})".format(
+                ratio, growth * 1000, args.max_latency_growth
+            )
+        )
+
+    return failures
+
+
+def report(message):
+    print(message, file=sys.stderr, flush=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="whr930_soak", description="Soak test the whr930 bridge"
+    )
+    parser.add_argument("--days", type=float, default=14, help="virtual days to run")
+    parser.add_argument(
+        "--max-minutes", type=float, default=60, help="stop after this real time"
+    )
+    parser.add_argument(
+        "--speed",
+        type=float,
+        default=0,
+        help="virtual seconds per real second for the background threads, 0 is as fast "
+        "as possible",
+    )
+    parser.add_argument(
+        "--sample-every", type=int, default=100, help="cycles between samples"
+    )
+    parser.add_argument(
+        "--command-every",
+        type=int,
+        default=10,
+        help="cycles between commands sent to the bridge",
+    )
+    parser.add_argument(
+        "--error-rate", type=float, default=0.0, help="fraction of corrupted replies"
+    )
+    parser.add_argument("--debug", action="store_true", help="enable debug messages")
+    parser.add_argument(
+        "--verbose", action="store_true", help="show the output of the bridge"
+    )
+    parser.add_argument("--samples", help="write the samples to this csv file")
+    parser.add_argument(
+        "--warm-up",
+        type=float,
+        default=0.1,
+        help="fraction of the samples before the reference window",
+    )
+    parser.add_argument("--max-rss-growth", type=float, default=8, help="MiB")
+    parser.add_argument("--max-fd-growth", type=int, default=0)
+    parser.add_argument("--max-thread-growth", type=int, default=0)
+    parser.add_argument("--max-backlog-growth", type=int, default=100)
+    parser.add_argument("--max-latency-growth", type=float, default=1.5)
+    parser.add_argument(
+        "--min-latency-growth",
+        type=float,
+        default=5,
+        help="ms, smaller latency growth never fails the run",
+    )
+    parser.add_argument(
+        "--alloc-cycles",
+        type=int,
+        default=100,
+        help="cycles of the allocation check, 0 skips it",
+    )
+    parser.add_argument("--max-alloc-growth", type=float, default=4, help="KiB")
+    args = parser.parse_args(argv)
+
+    with Path(whr930.__file__).with_name("config.yaml").open("r") as f:
+        config = yaml.safe_load(f.read())
+
+    server = MQTTServer()
+    config.update(
+        {
+            "mqtt_server": "127.0.0.1",
+            "mqtt_port": server.port,
+            "mqtt_username": None,
+            "mqtt_password": None,
+            "mqtt_tls": None,
+            "mqtt_protocol": 3,
+            "mqtt_brokers": [],
+            "port": "simulated",
+            "passive": False,
+            "http_port": 0,
+            "sinks": [],
+            "profile_cycles": 0,
+            "debug": args.debug,
+        }
+    )
+
+    clock = VirtualClock(args.speed)
+    whr930.time = clock
+    whr930.wakeup = VirtualEvent(clock)
+    whr930.open_serial = lambda port: SimulatedSerial(args.error_rate)
+
+    output = sys.stdout if args.verbose else open(os.devnull, "w")
+    functions = list(whr930.POLL_REPLIES)
+    commands = random.Random(1)
+    samples = []
+    cycle = 0
+    started = time.monotonic()
+    latency = []
+
+    with contextlib.redirect_stdout(output):
+        whr930.setup(config)
+        for broker in whr930.brokers:
+            broker.publish_interval = 0
+
+        sink_failures = check_sinks()
+
+        alloc_growth = alloc_peak = 0
+        if args.alloc_cycles > 0:
+            alloc_growth, alloc_peak = allocations(functions, args.alloc_cycles)
+
+        deadline = clock.monotonic() + args.days * 86400
+        while clock.monotonic() < deadline:
+            if time.monotonic() - started > args.max_minutes * 60:
+                report("Stopped after {} minutes".format(args.max_minutes))
+                break
+
+            if args.command_every > 0 and cycle % args.command_every == 0:
+                server.publish(
+                    "house/2/attic/wtw/set_ventilation_level",
+                    str(commands.randint(1, 3)).encode(),
+                )
+                server.publish("house/2/attic/wtw/refresh", b"temp,fans")
+
+            cycle_start = time.perf_counter()
+            whr930.run_cycle(functions)
+            latency.append(time.perf_counter() - cycle_start)
+            drain(1)
+            cycle += 1
+
+            if cycle % args.sample_every == 0:
+                rss, fds, threads = sample()
+                samples.append(
+                    {
+                        "cycle": cycle,
+                        "days": round(
+                            (args.days * 86400 - (deadline - clock.monotonic()))
+                            / 86400,
+                            3,
+                        ),
+                        "rss": rss,
+                        "fds": fds,
+                        "threads": threads,
+                        "latency": statistics.median(latency),
+                        "backlog": backlog(),
+                        "dropped": sum(broker.dropped for broker in whr930.brokers),
+                    }
+                )
+                latency = []
+
+                if len(samples) % 10 == 0:
+                    report(
+                        "day {days}: cycle {cycle}, rss {rss} KiB, fds {fds}, threads "
+                        "{threads}, latency {latency:.4f} s, backlog {backlog}".format(
+                            **samples[-1]
+                        )
+                    )
+
+        whr930.shutdown()
+
+    if args.samples is not None:
+        with open(args.samples, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=list(samples[0]) if samples else [])
+            writer.writeheader()
+            writer.writerows(samples)
+
+    report(
+        "{} cycles in {:.0f} seconds, {} MQTT messages, serial {}".format(
+            cycle, time.monotonic() - started, server.received, whr930.serial_stats
+        )
+    )
+    if args.alloc_cycles > 0:
+        report(
+            "Allocations: {} bytes held after {} cycles, peak {} bytes per cycle".format(
+                alloc_growth, args.alloc_cycles, alloc_peak
+            )
+        )
+
+    if len(samples) < 10:
+        report("Not enough samples, run longer or sample more often")
+        return 1
+
+    failures = sink_failures + check(samples, args)
+    if alloc_growth > args.max_alloc_growth * 1024:
+        failures.append(
+            "whr930.py held {} bytes more after {} cycles (limit {} KiB)".format(
+                alloc_growth, args.alloc_cycles, args.max_alloc_growth
+            )
+        )
+    for failure in failures:
+        report("FAIL: {}".format(failure))
+
+    if not failures:
+        report("PASS")
+
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())